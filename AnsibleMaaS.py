@@ -2,33 +2,243 @@
 # MaaS to Ansible Inventory Script
 # Import modules needed for this to work
 # If this errors use "pip" to install the needed modules (in requirements.txt)
+import argparse
+import atexit
+import bisect
+import fcntl
 import getpass
+import hashlib
+import http.client
 import ipaddress
 import json
 import os
+import random
+import re
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import cached_property, partial, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlencode, urljoin, urlsplit
 
-import maas.client
 from dotenv import load_dotenv
-from maas.client.enum import PowerState
-from packaging import version
-
-# Stuff needed to integrate as an Ansible plugin
-# from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable
-# class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
-#     NAME = 'AnsibleMaaS'
-#
-#     def verify_file(self, path):
-#         ''' return true/false if this is possibly a valid file for this plugin to consume '''
-#         valid = False
-#         if super(InventoryModule, self).verify_file(path):
-#             if path.endswith(('AnsibleMaaS.yaml', 'AnsibleMaaS.yml')):
-#                 valid = True
-#         return valid
-#
-#     def parse(self, inventory, loader, path, cache=True):
-#         self.loader = loader
-#         self.inventory = inventory
-#         self.templar = Templar(loader=loader)
+
+# maas.client, packaging and asyncio are imported when first needed,
+# so that importing this module or answering from the cache stays fast
+
+DOCUMENTATION = r'''
+    name: AnsibleMaaS
+    short_description: Canonical MaaS inventory source
+    description:
+        - Get the machines, and optionally the rack controllers, of Canonical MaaS
+          grouped by tag, availability zone, resource pool or region.
+        - Uses a YAML configuration file ending with AnsibleMaaS.yml or AnsibleMaaS.yaml.
+        - The options not given keep the values set in the CONFIGURATION of AnsibleMaaS.py.
+        - All the hosts are in the maas group.
+    extends_documentation_fragment:
+        - constructed
+        - inventory_cache
+    options:
+        plugin:
+            description: token that ensures this is a source file for the AnsibleMaaS plugin.
+            required: true
+            choices: ['AnsibleMaaS']
+        maas_url:
+            description: URL of the MaaS API, e.g. http://maas:5240/MAAS/
+            type: str
+            env:
+                - name: MAAS_URL
+        maas_api_key:
+            description: API key of the MaaS user.
+            type: str
+            env:
+                - name: MAAS_API_KEY
+        group_by_tags:
+            description: create a group for each tag.
+            type: bool
+            env:
+                - name: MAAS_GROUP_BY_TAGS
+        group_by_az:
+            description: create a group for each availability zone.
+            type: bool
+            env:
+                - name: MAAS_GROUP_BY_AZ
+        group_by_pool:
+            description: create a group for each resource pool.
+            type: bool
+            env:
+                - name: MAAS_GROUP_BY_POOL
+        include_bare_metal:
+            description: include the hosts which are not KVM (virsh or lxd) machines.
+            type: bool
+            env:
+                - name: MAAS_INCLUDE_BARE_METAL
+        include_host_details:
+            description: include all the known attributes of the hosts, or only ansible_host, ansible_user and hostname.
+            type: bool
+            env:
+                - name: MAAS_INCLUDE_HOST_DETAILS
+        host_fields:
+            description: hostvars to include with include_host_details, all of them when not set.
+            type: list
+            elements: str
+            env:
+                - name: MAAS_HOST_FIELDS
+        include_rack_controllers:
+            description: include the rack controllers.
+            type: bool
+            env:
+                - name: MAAS_INCLUDE_RACK_CONTROLLERS
+        exclude_powered_off_machines:
+            description: exclude the machines which are not powered on.
+            type: bool
+            env:
+                - name: MAAS_EXCLUDE_POWERED_OFF_MACHINES
+        ansible_management_space_name:
+            description: space of the IP used as ansible_host.
+            type: str
+            env:
+                - name: MAAS_ANSIBLE_MANAGEMENT_SPACE_NAME
+        maas_regions:
+            description:
+                - names of several MaaS regions merged in one inventory, instead of maas_url.
+                - the URL and API key of a region are read from MAAS_URL_<NAME> and MAAS_API_KEY_<NAME>.
+            type: list
+            elements: str
+            env:
+                - name: MAAS_MAAS_REGIONS
+        region_hostname_collision:
+            description: keep only the host of the first region (first) or rename the others (rename).
+            type: str
+            choices: ['first', 'rename']
+            env:
+                - name: MAAS_REGION_HOSTNAME_COLLISION
+        snapshot_file:
+            description: file written by AnsibleMaaS.py --export-snapshot to read the MaaS state from.
+            type: path
+            env:
+                - name: MAAS_SNAPSHOT_FILE
+        use_bulk_payload:
+            description: build the tags, interfaces and block devices from the machines list payload.
+            type: bool
+            env:
+                - name: MAAS_USE_BULK_PAYLOAD
+        request_timeout:
+            description: seconds a request to the MaaS API may take, 0 for no timeout.
+            type: float
+            env:
+                - name: MAAS_REQUEST_TIMEOUT
+        request_retries:
+            description: times a failed GET request is retried.
+            type: int
+            env:
+                - name: MAAS_REQUEST_RETRIES
+        request_retry_backoff:
+            description: seconds before the first retry, doubled for each following one.
+            type: float
+            env:
+                - name: MAAS_REQUEST_RETRY_BACKOFF
+'''
+
+EXAMPLES = r'''
+# AnsibleMaaS.yml, with AnsibleMaaS.py in a directory of inventory_plugins and AnsibleMaaS in enable_plugins
+plugin: AnsibleMaaS
+maas_url: http://maas:5240/MAAS/
+group_by_az: true
+keyed_groups:
+  - key: architecture
+    prefix: arch
+compose:
+  ansible_python_interpreter: "'/usr/bin/python3'"
+cache: true
+cache_plugin: jsonfile
+cache_connection: ~/.cache/ansible-inventory
+'''
+
+# Ansible inventory plugin, only defined when Ansible loads this file as a plugin,
+# so that running it as an inventory script does not import Ansible
+if "ansible" in sys.modules:
+    from ansible.errors import AnsibleParserError
+    from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable, Constructable
+
+    class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
+        NAME = 'AnsibleMaaS'
+
+        # options of the YAML file and the module variables they set
+        module_options = {
+            "maas_url": "maas_url",
+            "maas_api_key": "api_key",
+            **{name: name for name in ("group_by_tags", "group_by_az", "group_by_pool", "include_bare_metal",
+                                       "include_host_details", "host_fields", "include_rack_controllers",
+                                       "exclude_powered_off_machines", "ansible_management_space_name",
+                                       "maas_regions", "region_hostname_collision", "snapshot_file",
+                                       "use_bulk_payload",
+                                       "request_timeout", "request_retries", "request_retry_backoff")},
+        }
+
+        def verify_file(self, path):
+            ''' return true/false if this is possibly a valid file for this plugin to consume '''
+            valid = False
+            if super(InventoryModule, self).verify_file(path):
+                if path.endswith(('AnsibleMaaS.yaml', 'AnsibleMaaS.yml')):
+                    valid = True
+            return valid
+
+        def parse(self, inventory, loader, path, cache=True):
+            super(InventoryModule, self).parse(inventory, loader, path, cache)
+            self._read_config_data(path)
+            values = {}
+            for option, name in self.module_options.items():
+                value = self.get_option(option)
+                if value is not None:
+                    values[name] = value
+            with options(**values):
+                # the inventory of other options is cached under another key
+                cache_key = f"{self.get_cache_key(path)}_{get_cache_key()}"
+                user_cache_setting = self.get_option("cache")
+                attempt_to_read_cache = user_cache_setting and cache
+                cache_needs_update = user_cache_setting and not cache
+                data = None
+                if attempt_to_read_cache:
+                    try:
+                        data = self._cache[cache_key]
+                    except KeyError:
+                        cache_needs_update = True
+                if data is None:
+                    try:
+                        hosts, groups = get_hosts_and_groups()
+                    except RuntimeError as error:
+                        raise AnsibleParserError(str(error)) from error
+                    data = {
+                        "hosts": {hostname: host.to_plain_dict() for hostname, host in hosts.items()},
+                        "groups": groups,
+                    }
+                if cache_needs_update:
+                    self._cache[cache_key] = data
+            self.populate(data["hosts"], data["groups"])
+
+        def populate(self, hosts: dict, groups: dict):
+            strict = self.get_option("strict")
+            self.inventory.add_group("maas")
+            for hostname, hostvars in hosts.items():
+                self.inventory.add_host(hostname, group="maas")
+                for name, value in hostvars.items():
+                    self.inventory.set_variable(hostname, name, value)
+                self._set_composite_vars(self.get_option("compose"), hostvars, hostname, strict=strict)
+                self._add_host_to_composed_groups(self.get_option("groups"), hostvars, hostname, strict=strict)
+                self._add_host_to_keyed_groups(self.get_option("keyed_groups"), hostvars, hostname, strict=strict)
+            for group, hostnames in groups.items():
+                self.inventory.add_group(group)
+                for hostname in hostnames:
+                    self.inventory.add_host(hostname, group=group)
 
 
 # CONFIGURATION
@@ -42,6 +252,32 @@ include_host_details = True  # True will include all known attributes from MaaS
 include_rack_controllers = False  # True will include rack_controllers in the inventory
 exclude_powered_off_machines = True  # True will exclude machines without PowerState.ON
 
+# True will build tags, interfaces and block devices from the machines list payload
+# hosts whose payload misses some of these fields are fetched from the API objects instead
+use_bulk_payload = True
+
+# hostvars to include when include_host_details=True, None for all of them
+# ansible_host, ansible_user and hostname are always included
+# tags, interfaces and block_devices are only requested from MaaS when they are listed
+# e.g. ["zone", "tags", "interfaces"]
+host_fields = None
+
+# additional host groups, one for each value of a field of the machines list payload
+# the group names are "<prefix><separator><value>", prefix defaults to the key and separator to "_"
+# e.g. [{"key": "architecture", "prefix": "arch"}, {"key": "osystem", "prefix": "os"}, {"key": "distro_series"},
+#       {"key": "status_name", "prefix": "status"}]
+keyed_groups = []
+
+# REGIONS
+# names of several MaaS regions merged in one inventory, fetched in parallel, empty to only use MAAS_URL
+# the URL and API key of a region are read from the MAAS_URL_<NAME> and MAAS_API_KEY_<NAME> environment variables
+# e.g. ["paris", "lyon"] with MAAS_URL_PARIS, MAAS_API_KEY_PARIS, MAAS_URL_LYON and MAAS_API_KEY_LYON
+# the hosts of a region are also in a "region_<name>" group
+maas_regions = []
+# when a hostname is in several regions, the host of the first region listed is kept as is
+# "first" leaves the other hosts out of the inventory, "rename" adds them as "<hostname>_<region>"
+region_hostname_collision = 'first'
+
 # name of space to get ip of machines for ansible
 ansible_management_space_name = 'management'
 
@@ -53,314 +289,1822 @@ centos7_user = "centos"
 centos8_user = "cloud-user"
 windows_user = "cloud-admin"
 
+# True will print compact JSON, streamed as hosts are built when the cache is not used
+# the output is the same as the indented one once parsed
+compact_output = False
+
+# MAAS API REQUESTS
+# connections to the region API are kept open and reused for the whole run
+request_timeout = 30.0  # seconds a request to the MaaS API may take, 0 for no timeout
+# times a failed GET request is retried, after a connection error, a timeout or a 429, 502, 503 or 504 response
+request_retries = 3
+# seconds before the first retry, doubled for each following one, a random part of it is removed (jitter)
+request_retry_backoff = 0.5
+
+# CACHE
+# the generated inventory can be stored on disk and shared by concurrent runs
+use_cache = False  # True will reuse the inventory stored in cache_dir while it is fresh
+cache_dir = os.path.join(os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'AnsibleMaaS')
+cache_ttl = 300  # seconds during which a cached inventory is used as is
+# seconds after cache_ttl during which a stale inventory is still returned
+# while a background process refreshes it, 0 to always wait for the refresh
+cache_stale_ttl = 0
+cache_max_entries = 16  # oldest cached inventories are removed above this number
+
+# SNAPSHOT
+# AnsibleMaaS.py --export-snapshot FILE writes the MaaS state both scripts are built from (machines, rack controllers,
+# tags, zones, pools, spaces, subnets, discoveries and reserved ranges) to a compressed file
+# the path of such a file to build the inventory from it instead of requesting MAAS_URL, None to request MaaS
+snapshot_file = None
+# version of the snapshot files written, files of another version are refused
+snapshot_format = 1
+
+# DAEMON
+# AnsibleMaaS.py --serve keeps the inventory in memory, rebuilt every daemon_refresh_interval seconds,
+# and answers --list and --host over daemon_socket
+# with use_daemon=True, runs ask the daemon first and build the inventory themselves if it does not answer
+use_daemon = False
+# path of a Unix socket, or http://<address>:<port> to serve over HTTP
+daemon_socket = os.path.join(os.getenv('XDG_RUNTIME_DIR', tempfile.gettempdir()), f'AnsibleMaaS-{os.getuid()}.sock')
+daemon_refresh_interval = 60  # seconds between two rebuilds of the inventory served by the daemon
+daemon_timeout = 5.0  # seconds a run waits for the daemon before building the inventory itself
+
+# METRICS
+# timings of each phase of the run, count and latency of the MaaS API calls per endpoint, hosts and groups counts
+# "stderr" prints them as JSON on stderr at the end of the run, any other value is the path of a Prometheus textfile
+# they are written to (e.g. in the directory of the node_exporter textfile collector), None to not collect them
+metrics_output = None
+
+# seconds during which the version of a MaaS is not checked again, it is kept in cache_dir
+# (versions.json, never evicted with the cached inventories)
+version_check_ttl = 86400
+# Test MaaS version. Tested against 2.9.1 and newer. Earlier releases have functional gaps.
+reqver = "2.9.1"  # Minimum required version of MaaS
+
 load_dotenv()
 
 # Grab MAAS environment variables from the environment 
 api_key = os.getenv('MAAS_API_KEY')
 maas_url = os.getenv('MAAS_URL')
-# Test if environment variables were present
-if api_key is None:
-    raise OSError("MAAS_API_KEY environment variable is not set. Please set the MAAS_API_KEY environment variable!")
-if maas_url is None:
-    raise OSError("MAAS_URL environment variable is not set. Please set the MAAS_URL environment variable!")
-# Connect to the MaaS API
-client = maas.client.connect(maas_url, apikey=api_key)
 
-# Test MaaS version. Tested against 2.9.1 and newer. Earlier releases have functional gaps.
-reqver = "2.9.1"  # Minimum required version of MaaS
-ver = client.version.get()
-ver = str(ver.version)
-if version.parse(ver) < version.parse(reqver):
-    print("MaaS must be version ", reqver, " or newer")
-    print("Current MaaS version is:", ver, "\n")
-    quit()
-
-
-# Define function to pull machine instance info from the API and reformat data
-# to be more JSON and Ansible friendly
-def get_machines(meta: dict):
-    machines = [
-        machine for machine in client.machines.list()
+# clients connected to the MaaS API, by URL and API key, see get_client
+_clients = {}
+
+# metrics of the current run when metrics_output is set, see start_metrics
+metrics = None
+
+
+# Timings, API calls and counts of a run
+# phases include the phases run within them, e.g. the machines are listed within hosts
+class Metrics:
+    def __init__(self, script: str):
+        self.script = script
+        self.started = time.time()
+        self.phases = {}
+        self.api_calls = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            # regions run their phases in parallel
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    # called from the threads fetching host details
+    def add_api_call(self, endpoint: str, seconds: float):
+        with self._lock:
+            count, total = self.api_calls.get(endpoint, (0, 0.0))
+            self.api_calls[endpoint] = (count + 1, total + seconds)
+
+    def increment_count(self, name: str):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def to_dict(self):
+        return {
+            "script": self.script,
+            "phases": self.phases,
+            "api_calls": {
+                endpoint: {"count": count, "seconds": seconds} for endpoint, (count, seconds) in self.api_calls.items()
+            },
+            "counts": self.counts,
+        }
+
+    def to_prometheus(self):
+        script = f'script="{self.script}"'
+        lines = [
+            "# HELP ansible_maas_phase_seconds Time spent in each phase of the last run.",
+            "# TYPE ansible_maas_phase_seconds gauge",
+        ]
+        lines += [f'ansible_maas_phase_seconds{{{script},phase="{name}"}} {seconds}'
+                  for name, seconds in self.phases.items()]
+        lines += [
+            "# HELP ansible_maas_api_requests Number of MaaS API requests of the last run.",
+            "# TYPE ansible_maas_api_requests gauge",
+        ]
+        lines += [f'ansible_maas_api_requests{{{script},endpoint="{endpoint}"}} {count}'
+                  for endpoint, (count, _) in self.api_calls.items()]
+        lines += [
+            "# HELP ansible_maas_api_request_seconds Time spent waiting for MaaS API requests in the last run.",
+            "# TYPE ansible_maas_api_request_seconds gauge",
+        ]
+        lines += [f'ansible_maas_api_request_seconds{{{script},endpoint="{endpoint}"}} {seconds}'
+                  for endpoint, (_, seconds) in self.api_calls.items()]
+        for name, value in self.counts.items():
+            lines += [
+                f"# HELP ansible_maas_{name} Number of {name.replace('_', ' ')} of the last run.",
+                f"# TYPE ansible_maas_{name} gauge",
+                f"ansible_maas_{name}{{{script}}} {value}",
+            ]
+        lines += [
+            "# HELP ansible_maas_last_run_timestamp_seconds Time the last run started.",
+            "# TYPE ansible_maas_last_run_timestamp_seconds gauge",
+            f"ansible_maas_last_run_timestamp_seconds{{{script}}} {self.started}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+# Time the phase name of the run when the metrics are collected
+def phase(name: str):
+    if metrics is None:
+        return nullcontext()
+    return metrics.phase(name)
+
+
+# Decorator timing every call of a function as the phase name
+def timed(name: str):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if metrics is None:
+                return function(*args, **kwargs)
+            with metrics.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_count(name: str, value: int):
+    if metrics is not None:
+        metrics.counts[name] = value
+
+
+# Collect the metrics of this run if metrics_output is set
+def start_metrics(script: str):
+    global metrics
+    if metrics_output is None:
+        return
+    metrics = Metrics(script)
+
+
+# Output the metrics collected since start_metrics, the textfile is replaced atomically for the collector
+def write_metrics():
+    global metrics
+    if metrics is None:
+        return
+    run_metrics, metrics = metrics, None
+    if metrics_output == "stderr":
+        print(json.dumps(run_metrics.to_dict()), file=sys.stderr)
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(metrics_output)), prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            tmp_file.write(run_metrics.to_prometheus())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, metrics_output)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# HTTP statuses of the responses to GET requests that are retried
+retry_statuses = (429, 502, 503, 504)
+
+# aiohttp sessions kept open until the process exits, by event loop as a session cannot be shared between loops
+# there is one loop per thread calling the API, see get_executor
+_http_sessions = {}
+
+
+def get_http_session(insecure: bool):
+    import asyncio
+    import aiohttp
+    loop = asyncio.get_event_loop()
+    http_session = _http_sessions.get((loop, insecure))
+    if http_session is None:
+        if not _http_sessions:
+            atexit.register(close_http_sessions)
+        # the timeout is given to each request, see send_api_request, as request_timeout can change
+        http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=not insecure))
+        _http_sessions[(loop, insecure)] = http_session
+    return http_session
+
+
+def close_http_sessions():
+    for (loop, _), http_session in _http_sessions.items():
+        if not loop.is_closed() and not loop.is_running():
+            loop.run_until_complete(http_session.close())
+    _http_sessions.clear()
+
+
+# Seconds to wait before the retry number attempt (from 1)
+def get_retry_delay(attempt: int):
+    delay = request_retry_backoff * 2 ** (attempt - 1)
+    return delay - random.uniform(0, delay / 2)
+
+
+# Send a request to the MaaS API, each attempt bounded by request_timeout, and return the response and its content
+# GET requests are retried after connection errors, timeouts and retry_statuses, any other response is returned
+# credentials sign each retry again, as MaaS rejects a reused OAuth nonce
+async def send_api_request(method: str, uri: str, insecure: bool, body=None, headers: dict = None,
+                           credentials: tuple = None):
+    import asyncio
+    import aiohttp
+    from maas.client.utils import sign
+    http_session = get_http_session(insecure)
+    timeout = aiohttp.ClientTimeout(total=request_timeout or None)
+    attempts = request_retries + 1 if method == "GET" else 1
+    for attempt in range(attempts):
+        if attempt:
+            if metrics is not None:
+                metrics.increment_count("api_retries")
+            await asyncio.sleep(get_retry_delay(attempt))
+            if credentials is not None:
+                headers = dict(headers)
+                sign(uri, headers, credentials)
+        try:
+            async with http_session.request(method, uri, data=body, headers=headers, timeout=timeout) as response:
+                content = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt + 1 == attempts:
+                raise
+            continue
+        if response.status not in retry_statuses:
+            break
+    return response, content
+
+
+# Replacement of python-libmaas CallAPI.dispatch, which opens a new connection for every request:
+# the requests of a thread share a session, are bounded by request_timeout, and GET requests are retried.
+# Every call is timed by endpoint (e.g. Machines.read) when metrics are collected.
+async def dispatch_api_call(self, uri, body, headers):
+    from maas.client.bones import CallError, CallResult, _prefer_json
+    method = self.action.method
+    session = self.action.handler.session
+    start = time.perf_counter()
+    response, content = await send_api_request(method, uri, session.insecure, body=body,
+                                               headers=_prefer_json(headers), credentials=session.credentials)
+    if metrics is not None:
+        metrics.add_api_call(self.action.fullname, time.perf_counter() - start)
+    if session.debug:
+        print(response)
+    if response.status // 100 != 2:
+        request = {"body": body, "headers": headers, "method": method, "uri": uri}
+        raise CallError(request, response, content, self)
+    if response.content_type is not None and response.content_type.endswith("/json"):
+        data = json.loads(content.decode("utf-8"))
+    else:
+        data = content
+    return CallResult(response, content, data)
+
+
+# Replacement of python-libmaas helpers.fetch_api_description, which connects without any timeout:
+# the API description is requested like the other GET requests
+async def fetch_api_description(url, insecure: bool = False):
+    from maas.client.bones.helpers import RemoteError, _ensure_url_string
+    response, content = await send_api_request("GET", urljoin(_ensure_url_string(url), "describe/"), insecure)
+    if response.status != 200:
+        raise RemoteError("{0} -> {1.status} {1.reason}".format(url, response))
+    if response.content_type != "application/json":
+        raise RemoteError("Expected application/json, got: %s" % response.content_type)
+    return json.loads(content.decode("utf-8"))
+
+
+def install_api_requests():
+    from maas.client.bones import CallAPI, helpers
+    from maas.client.utils.maas_async import asynchronous
+    if CallAPI.dispatch.__wrapped__ is not dispatch_api_call:
+        CallAPI.dispatch = asynchronous(dispatch_api_call)
+    helpers.fetch_api_description = fetch_api_description
+
+
+# Connect, fetching the API description with request_timeout and retries, see fetch_api_description
+def connect(url: str, key: str):
+    import maas.client
+    install_api_requests()
+    return maas.client.connect(url, apikey=key)
+
+
+# Names of the environment variables holding the URL and API key of a region
+def get_region_variables(region: str = None):
+    if region is None:
+        return "MAAS_URL", "MAAS_API_KEY"
+    suffix = "_" + re.sub(r"[^A-Za-z0-9]", "_", region).upper()
+    return "MAAS_URL" + suffix, "MAAS_API_KEY" + suffix
+
+
+# URL of the MaaS of a region, maas_url for None
+def get_region_url(region: str = None):
+    if region is None:
+        return maas_url
+    return os.getenv(get_region_variables(region)[0])
+
+
+# Connect to the MaaS API of a region (None for MAAS_URL) on first use and check its version
+def get_client(region: str = None):
+    url_variable, key_variable = get_region_variables(region)
+    url = get_region_url(region)
+    key = api_key if region is None else os.getenv(key_variable)
+    # Test if environment variables were present
+    if key is None:
+        raise OSError(
+            f"{key_variable} environment variable is not set. Please set the {key_variable} environment variable!"
+        )
+    if url is None:
+        raise OSError(
+            f"{url_variable} environment variable is not set. Please set the {url_variable} environment variable!"
+        )
+    maas_client = _clients.get((url, key))
+    if maas_client is None:
+        with phase("connect"):
+            maas_client = connect(url, key)
+            check_maas_version(maas_client, url)
+        _clients[(url, key)] = maas_client
+    return maas_client
+
+
+# the client used to be a module attribute, keep AnsibleMaaS.client working
+def __getattr__(name):
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Version of the MaaS at url, from cache_dir if it was checked less than version_check_ttl seconds ago
+def get_maas_version(maas_client, url: str = None):
+    if url is None:
+        url = maas_url
+    versions_path = os.path.join(cache_dir, "versions.json")
+    versions, _ = read_cache(versions_path)
+    if not isinstance(versions, dict):
+        versions = {}
+    cached = versions.get(url)
+    if cached is not None and time.time() - cached["checked"] <= version_check_ttl:
+        return cached["version"]
+    ver = str(maas_client.version.get().version)
+    versions[url] = {"version": ver, "checked": time.time()}
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_cache(versions_path, versions)
+    except OSError:
+        # not being able to remember it only costs a request on the next run
+        pass
+    return ver
+
+
+# raises RuntimeError for an older MaaS, this code also runs in the threads of the regions,
+# in the daemon and in the process of Ansible, so it must not exit
+def check_maas_version(maas_client, url: str = None):
+    from packaging import version
+    ver = get_maas_version(maas_client, url)
+    if version.parse(ver) < version.parse(reqver):
+        raise RuntimeError(f"MaaS must be version {reqver} or newer,"
+                           f" current MaaS version of {url or maas_url} is {ver}")
+
+
+# Snapshot of the MaaS state used to build the inventory.
+# Each resource is fetched from the API at most once, the first time it is needed,
+# and is then shared by get_machines and every group builder.
+# hostnames limits the machines and rack_controllers to these hosts, filtered by the API
+# region is the one of maas_regions the client is connected to, None for MAAS_URL
+class Snapshot:
+    def __init__(self, maas_client, hostnames: list = None, region: str = None):
+        self.client = maas_client
+        self.hostnames = hostnames
+        self.region = region
+        # time the MaaS state is from
+        self.taken_at = time.time()
+        # details of the hosts fetched from their objects, by (system_id, sub_resources),
+        # so that inventories built with other options from the same snapshot do not fetch them again
+        self.fetched_details = {}
+        # host records built from this snapshot, by (system_id, get_host_options(), ...)
+        self.built_hosts = {}
+
+    # True when the MaaS state is read from a snapshot file, see OfflineSnapshot
+    offline = False
+
+    @cached_property
+    @timed("list_machines")
+    def machines(self):
+        return list(self.client.machines.list(hostnames=self.hostnames))
+
+    @cached_property
+    @timed("list_rack_controllers")
+    def rack_controllers(self):
+        return list(self.client.rack_controllers.list(hostnames=self.hostnames))
+
+    @cached_property
+    @timed("list_tags")
+    def tags(self):
+        return list(self.client.tags.list())
+
+    @cached_property
+    @timed("list_zones")
+    def zones(self):
+        return list(self.client.zones.list())
+
+    @cached_property
+    @timed("list_pools")
+    def pools(self):
+        return list(self.client.resource_pools.list())
+
+    @cached_property
+    @timed("list_spaces")
+    def spaces(self):
+        return list(self.client.spaces.list())
+
+    @cached_property
+    @timed("list_subnets")
+    def subnets(self):
+        return list(self.client.subnets.list())
+
+    # decoded JSON payloads, MaaS does not give the discoveries as objects
+    @cached_property
+    @timed("list_discoveries")
+    def discoveries(self):
+        return get_api_session(self.client).Discoveries.read()
+
+    # ranges MaaS reserves (dynamic, reserved, gateway...) in a subnet, decoded JSON payloads
+    def get_reserved_ip_ranges(self, subnet_id: int):
+        return get_api_session(self.client).Subnet.reserved_ip_ranges(id=subnet_id)
+
+    @cached_property
+    @timed("subnet_index")
+    def subnet_index(self):
+        return SubnetIndex(self.subnets, self.spaces)
+
+
+# MaaS state read from a snapshot file written by export_snapshot, without any request to MaaS
+# each list is decompressed and built into the python-libmaas objects of a Snapshot on first use
+class OfflineSnapshot(Snapshot):
+    offline = True
+
+    def __init__(self, path: str, hostnames: list = None):
+        super().__init__(None, hostnames=hostnames)
+        self.path = path
+        with zipfile.ZipFile(path) as archive:
+            self.metadata = json.loads(archive.read("snapshot.json"))
+        if self.metadata.get("format") != snapshot_format:
+            raise ValueError(f"{path} is a snapshot of format {self.metadata.get('format')!r},"
+                             f" only format {snapshot_format} is supported")
+        self.taken_at = self.metadata["created"]
+
+    def read(self, name: str):
+        with zipfile.ZipFile(self.path) as archive:
+            return json.loads(archive.read(name + ".json"))
+
+    # the objects are built from their payloads, the origin needs no API description nor connection
+    @cached_property
+    def origin(self):
+        from maas.client.bones import SessionAPI
+        from maas.client.viscera import Origin
+        return Origin(SessionAPI({"resources": []}))
+
+    def build(self, name: str, object_name: str, filter_hostnames: bool = False):
+        build_object = getattr(self.origin, object_name)
+        payloads = self.read(name)
+        if filter_hostnames and self.hostnames is not None:
+            payloads = [payload for payload in payloads if payload["hostname"] in self.hostnames]
+        return [build_object(payload) for payload in payloads]
+
+    @cached_property
+    @timed("list_machines")
+    def machines(self):
+        return self.build("machines", "Machine", filter_hostnames=True)
+
+    @cached_property
+    @timed("list_rack_controllers")
+    def rack_controllers(self):
+        return self.build("rack_controllers", "RackController", filter_hostnames=True)
+
+    @cached_property
+    @timed("list_tags")
+    def tags(self):
+        return self.build("tags", "Tag")
+
+    @cached_property
+    @timed("list_zones")
+    def zones(self):
+        return self.build("zones", "Zone")
+
+    @cached_property
+    @timed("list_pools")
+    def pools(self):
+        return self.build("pools", "ResourcePool")
+
+    @cached_property
+    @timed("list_spaces")
+    def spaces(self):
+        return self.build("spaces", "Space")
+
+    @cached_property
+    @timed("list_subnets")
+    def subnets(self):
+        return self.build("subnets", "Subnet")
+
+    @cached_property
+    @timed("list_discoveries")
+    def discoveries(self):
+        return self.read("discoveries")
+
+    @cached_property
+    def reserved_ip_ranges(self):
+        return self.read("reserved_ip_ranges")
+
+    def get_reserved_ip_ranges(self, subnet_id: int):
+        return self.reserved_ip_ranges.get(str(subnet_id), [])
+
+
+# Snapshot of the MaaS of a region (None for MAAS_URL), read from snapshot_file when it is set
+def get_snapshot(hostnames: list = None, region: str = None):
+    if snapshot_file:
+        if region is not None:
+            raise ValueError("snapshot_file holds the state of a single MaaS, it cannot be used with maas_regions")
+        return OfflineSnapshot(snapshot_file, hostnames=hostnames)
+    return Snapshot(get_client(region), hostnames=hostnames, region=region)
+
+
+# python-libmaas API handlers, answering the decoded JSON payloads without building an object for each item
+def get_api_session(maas_client):
+    return maas_client._origin.Subnets._handler.session
+
+
+# Write the MaaS state of MAAS_URL to path as a snapshot_file, one compressed JSON member per list
+# the details of the nodes must be in their list payloads, as the snapshot is only read from them
+@timed("export")
+def export_snapshot(path: str):
+    maas_client = get_client()
+    session = get_api_session(maas_client)
+    sections = {
+        "machines": session.Machines.read(),
+        "rack_controllers": session.RackControllers.read(),
+        "tags": session.Tags.read(),
+        "zones": session.Zones.read(),
+        "pools": session.ResourcePools.read(),
+        "spaces": session.Spaces.read(),
+        "subnets": session.Subnets.read(),
+        "discoveries": session.Discoveries.read(),
+    }
+    sections["reserved_ip_ranges"] = {
+        str(subnet["id"]): session.Subnet.reserved_ip_ranges(id=subnet["id"]) for subnet in sections["subnets"]
+    }
+    rack_controller_sub_resources = tuple(name for name in host_sub_resources if name != "block_devices")
+    missing = [payload["hostname"] for payload in sections["machines"] if not payload_has_details(payload)]
+    missing += [payload["hostname"] for payload in sections["rack_controllers"]
+                if not payload_has_details(payload, rack_controller_sub_resources)]
+    if missing:
+        raise ValueError(f"the list payloads of {len(missing)} nodes miss their tags, interfaces or block devices,"
+                         f" a snapshot cannot be built from them: {', '.join(missing)}")
+    sections["snapshot"] = {
+        "format": snapshot_format,
+        "maas_url": maas_url,
+        "maas_version": get_maas_version(maas_client),
+        "created": time.time(),
+    }
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file, zipfile.ZipFile(tmp_file, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name, data in sections.items():
+                archive.writestr(name + ".json", json.dumps(data, separators=(",", ":")))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# A subnet of the SubnetIndex, start and end are the first and last addresses as integers
+IndexedSubnet = namedtuple("IndexedSubnet", ["start", "end", "network", "subnet", "vlan_id", "space"])
+
+
+# Index of the subnets of MaaS finding the subnet, VLAN and space of an IP address in O(log n)
+# subnets are sorted integer ranges, one list per IP version, searched with bisect
+# MaaS does not allow overlapping subnets, so the closest range starting before an address is the only candidate
+class SubnetIndex:
+    def __init__(self, subnets, spaces):
+        vlan_spaces = {vlan.id: space.name for space in spaces for vlan in space.vlans}
+        self.space_subnets = {}
+        indexed_subnets = []
+        for subnet in subnets:
+            network = ipaddress.ip_network(subnet.cidr)
+            vlan_id = subnet.vlan.id
+            space = vlan_spaces.get(vlan_id)
+            indexed_subnet = IndexedSubnet(
+                int(network.network_address), int(network.broadcast_address), network, subnet, vlan_id, space
+            )
+            indexed_subnets.append(indexed_subnet)
+            if space is not None:
+                self.space_subnets.setdefault(space, []).append(indexed_subnet)
+        self.ranges = {4: [], 6: []}
+        for indexed_subnet in sorted(indexed_subnets, key=lambda indexed: indexed.start):
+            self.ranges[indexed_subnet.network.version].append(indexed_subnet)
+        self.starts = {ip_version: [indexed.start for indexed in ranges] for ip_version, ranges in self.ranges.items()}
+
+    # IndexedSubnet containing the IP address, None if it is in no known subnet
+    def get(self, ip: str):
+        address = ipaddress.ip_address(ip)
+        value = int(address)
+        index = bisect.bisect_right(self.starts[address.version], value) - 1
+        if index >= 0:
+            indexed_subnet = self.ranges[address.version][index]
+            if value <= indexed_subnet.end:
+                return indexed_subnet
+        return None
+
+    # networks of the subnets of a space, in the order of the subnets list
+    def get_space_networks(self, space: str):
+        return [indexed_subnet.network for indexed_subnet in self.space_subnets.get(space, [])]
+
+    # first of the IP addresses belonging to one of the subnets of the space, None if there is none
+    def get_space_ip(self, ip_addresses: list, space: str):
+        for ip in ip_addresses:
+            indexed_subnet = self.get(ip)
+            if indexed_subnet is not None and indexed_subnet.space == space:
+                return ip
+        return None
+
+
+# machines of the snapshot to include in the inventory
+def get_inventory_machines(snapshot: Snapshot):
+    from maas.client.enum import PowerState
+    return [
+        machine for machine in snapshot.machines
         if not exclude_powered_off_machines or (machine.power_state == PowerState.ON and exclude_powered_off_machines)
     ]
-    rack_controllers = []
+
+
+# rack_controllers of the snapshot to include in the inventory, empty if include_rack_controllers=False
+def get_inventory_rack_controllers(snapshot: Snapshot):
+    if include_rack_controllers:
+        return snapshot.rack_controllers
+    return []
+
+
+# python-libmaas runs its requests on the event loop of the calling thread,
+# so each worker thread of the pool needs its own
+def init_worker_event_loop():
+    import asyncio
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+
+# (number of workers, executor) by name, fetching the regions, kept for the whole process
+# so that the threads keep their event loop and HTTP connections between inventories
+# the lock makes concurrent callers share the same executor
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name: str, workers: int):
+    with _executors_lock:
+        executor_workers, executor = _executors.get(name, (None, None))
+        if executor_workers != workers:
+            # the replaced executor finishes the tasks already submitted, then its threads exit
+            if executor is not None:
+                executor.shutdown(wait=False)
+            executor = ThreadPoolExecutor(max_workers=workers, initializer=init_worker_event_loop)
+            _executors[name] = (workers, executor)
+        return executor
+
+
+# a forked child has none of the threads of the executors, and must not use the connections of its parent
+def reset_after_fork():
+    global _executors, _executors_lock, _http_sessions
+    _executors = {}
+    _executors_lock = threading.Lock()
+    _http_sessions = {}
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+# Records the inventory is built from, slotted objects are much smaller than the dictionaries of the output,
+# they are only converted when the inventory is output, by the JSON encoders through to_plain_data
+class Interface:
+    __slots__ = ("name", "type", "enabled", "id", "mac_address", "params", "mtu")
+
+    def __init__(self, name, type, enabled, id, mac_address, params, mtu):
+        self.name = name
+        self.type = type
+        self.enabled = enabled
+        self.id = id
+        self.mac_address = mac_address
+        self.params = params
+        self.mtu = mtu
+
+    # output as {name: {type, enabled...}}
+    def to_dict(self):
+        return {self.name: {key: getattr(self, key) for key in self.__slots__[1:]}}
+
+
+class BlockDevice:
+    __slots__ = ("name", "type", "model", "used_for", "size", "used", "block_size", "id", "id_path")
+
+    def __init__(self, name, type, model, used_for, size, used, block_size, id, id_path):
+        self.name = name
+        self.type = type
+        self.model = model
+        self.used_for = used_for
+        self.size = size
+        self.used = used
+        self.block_size = block_size
+        self.id = id
+        self.id_path = id_path
+
+    # output as {name: {type, model...}}
+    def to_dict(self):
+        return {self.name: {key: getattr(self, key) for key in self.__slots__[1:]}}
+
+
+# hostvars of a machine in output order, the ones of a rack controller
+machine_host_keys = ("ansible_host", "ansible_user", "hostname", "status", "netboot", "architecture", "os",
+                     "distro_series", "fqdn", "cpus", "memory", "interfaces", "ip_addresses", "system_id",
+                     "operating_system", "node_type", "pool", "zone", "block_devices", "tags")
+rack_controller_host_keys = ("ansible_host", "ansible_user", "hostname", "architecture", "os", "distro_series", "fqdn",
+                             "cpus", "memory", "interfaces", "ip_addresses", "system_id", "operating_system",
+                             "node_type", "zone", "tags")
+
+
+# hostvars of a host, keys are the hostvars to output, shared by the hosts built with the same options
+# the hostvars out of keys are not set
+class Host:
+    __slots__ = ("keys",) + machine_host_keys
+
+    def __init__(self, keys: tuple, ansible_host, ansible_user, hostname):
+        self.keys = keys
+        self.ansible_host = ansible_host
+        self.ansible_user = ansible_user
+        self.hostname = hostname
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.keys}
+
+    # hostvars as plain data for the consumers which are not JSON encoders, e.g. the Ansible inventory plugin
+    def to_plain_dict(self):
+        host = self.to_dict()
+        for key in ("interfaces", "block_devices"):
+            if key in host:
+                host[key] = [item.to_dict() for item in host[key]]
+        return host
+
+
+# default of the JSON encoders
+def to_plain_data(value):
+    if isinstance(value, (Host, Interface, BlockDevice)):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# fields of the list payload needed to build the details of a node without walking its objects
+interface_payload_fields = ("name", "type", "enabled", "id", "mac_address", "params", "effective_mtu")
+block_device_payload_fields = ("name", "type", "model", "used_for", "size", "used_size", "block_size", "id", "id_path")
+
+
+# Build a list of network interfaces from the interface objects of a node
+def get_interfaces(interfaces):
+    return [
+        Interface(
+            interface.name,
+            interface.type.name,
+            interface.enabled,
+            interface.id,
+            interface.mac_address,
+            interface.params,
+            interface.effective_mtu,
+        )
+        for interface in interfaces
+    ]
+
+
+# Build a list of block devices (disks) from the block device objects of a node
+def get_block_devices(block_devices):
+    return [
+        BlockDevice(
+            block_device.name,
+            block_device.type.name,
+            block_device.model,
+            block_device.used_for,
+            block_device.size,
+            block_device.used_size,
+            block_device.block_size,
+            block_device.id,
+            block_device.id_path,
+        )
+        for block_device in block_devices
+    ]
+
+
+# Same as get_interfaces but from the "interface_set" of the list payload
+def get_payload_interfaces(interface_set: list):
+    from maas.client.enum import InterfaceType
+    return [
+        Interface(
+            interface["name"],
+            InterfaceType(interface["type"]).name,
+            interface["enabled"],
+            interface["id"],
+            interface["mac_address"],
+            interface["params"],
+            interface["effective_mtu"],
+        )
+        for interface in interface_set
+    ]
+
+
+# Same as get_block_devices but from the "blockdevice_set" of the list payload
+def get_payload_block_devices(blockdevice_set: list):
+    from maas.client.enum import BlockDeviceType
+    return [
+        BlockDevice(
+            block_device["name"],
+            BlockDeviceType(block_device["type"]).name,
+            block_device["model"],
+            block_device["used_for"],
+            block_device["size"],
+            block_device["used_size"],
+            block_device["block_size"],
+            block_device["id"],
+            block_device["id_path"],
+        )
+        for block_device in blockdevice_set
+    ]
+
+
+# hostvars in every host, whatever include_host_details and host_fields are
+base_host_fields = ("ansible_host", "ansible_user", "hostname")
+# sub-resources of a node, fetched only for the hostvars of the same name
+host_sub_resources = ("tags", "interfaces", "block_devices")
+
+
+# hostvars to output, None for all of them
+def get_host_fields():
+    if not include_host_details:
+        return set(base_host_fields)
+    if host_fields is None:
+        return None
+    return set(base_host_fields).union(host_fields)
+
+
+# sub-resources needed for the hostvars to output
+def get_sub_resources(fields: set):
+    return tuple(sub_resource for sub_resource in host_sub_resources if fields is None or sub_resource in fields)
+
+
+# True if every item of the payload list contains all the fields
+def payload_has_fields(items, fields: tuple):
+    return isinstance(items, list) and all(field in item for item in items for field in fields)
+
+
+# Build the tags, interfaces and block devices of a node from its list payload
+# only the sub_resources are built, the others are left empty
+# returns None when the payload misses some fields (older MaaS versions)
+def get_payload_details(node, sub_resources: tuple = host_sub_resources):
+    payload = node._data
+    if not payload_has_details(payload, sub_resources):
+        return None
+    return (
+        list(payload["tag_names"]) if "tags" in sub_resources else [],
+        get_payload_interfaces(payload["interface_set"]) if "interfaces" in sub_resources else [],
+        get_payload_block_devices(payload["blockdevice_set"]) if "block_devices" in sub_resources else [],
+    )
+
+
+# True if the list payload of a node has all the fields of the sub_resources to build them
+def payload_has_details(payload: dict, sub_resources: tuple = host_sub_resources):
+    tag_names = payload.get("tag_names") if "tags" in sub_resources else []
+    interface_set = payload.get("interface_set") if "interfaces" in sub_resources else []
+    blockdevice_set = payload.get("blockdevice_set") if "block_devices" in sub_resources else []
+    return isinstance(tag_names, list) \
+        and payload_has_fields(interface_set, interface_payload_fields) \
+        and payload_has_fields(blockdevice_set, block_device_payload_fields)
+
+
+# Fetch the tags, interfaces and block devices of a node by walking its objects
+# only the sub_resources are fetched, the others are left empty
+def get_host_details(node, sub_resources: tuple = host_sub_resources):
+    tags = [tag.name for tag in node.tags] if "tags" in sub_resources else []
+    interfaces = get_interfaces(node.interfaces) if "interfaces" in sub_resources else []
+    block_devices = get_block_devices(node.block_devices) if "block_devices" in sub_resources else []
+    return tags, interfaces, block_devices
+
+
+# Get the details of every node, from the list payload when use_payload (defaults to use_bulk_payload) is True,
+# the remaining nodes are built from their API objects, one after another: python-libmaas builds their tags,
+# interfaces and block devices from the list payload, without any request, so there is nothing to run in parallel
+# fetched holds the details already fetched from the objects of the nodes, see Snapshot.fetched_details
+# results are in the same order as nodes
+@timed("host_details")
+def get_hosts_details(nodes: list, sub_resources: tuple = host_sub_resources, fetched: dict = None,
+                      use_payload: bool = None):
+    if not sub_resources:
+        return [([], [], []) for _ in nodes]
+    if use_payload is None:
+        use_payload = use_bulk_payload
+    details = [get_payload_details(node, sub_resources) if use_payload else None for node in nodes]
+    missing = [index for index, node_details in enumerate(details) if node_details is None]
+    if fetched is not None and missing:
+        for index in missing:
+            node = nodes[index]
+            node_details = fetched.get((node.system_id, sub_resources))
+            if node_details is not None:
+                details[index] = node_details
+        missing = [index for index in missing if details[index] is None]
+    fetched_details = [get_host_details(nodes[index], sub_resources) for index in missing]
+    for index, node_details in zip(missing, fetched_details):
+        details[index] = node_details
+        if fetched is not None:
+            fetched[(nodes[index].system_id, sub_resources)] = node_details
+    return details
+
+
+# IP of the node in the ansible_management_space_name space
+# a node without one is still in the inventory, reachable through its fqdn
+def get_ansible_host(node, subnet_index: SubnetIndex):
+    ansible_ip = subnet_index.get_space_ip(node.ip_addresses, ansible_management_space_name)
+    if ansible_ip is None:
+        print(
+            f"WARNING: {node.hostname} has no IP address in space '{ansible_management_space_name}',"
+            f" using its fqdn {node.fqdn} as ansible_host",
+            file=sys.stderr
+        )
+        return node.fqdn
+    return ansible_ip
+
+
+# Build the Host record of a machine from its API object and details, with its ansible_user picked from its OS
+def get_machine_host(machine, details: tuple, subnet_index: SubnetIndex, keys: tuple):
+    tags, ifs, disks = details
+    ostype = str(machine.osystem)
+    oskernel = str(machine.distro_series)
+
+    ansible_user = none_user
+    # Determine the ansible_user to assign by OS
+    if machine.osystem == "ubuntu":
+        ansible_user = ubuntu_user
+    if machine.osystem == "centos" and machine.distro_series == "8":
+        ansible_user = centos8_user
+    if machine.osystem == "centos" and machine.distro_series == "7":
+        ansible_user = centos7_user
+
+    ansible_ip = get_ansible_host(machine, subnet_index)
+
+    host = Host(keys, ansible_ip, ansible_user, machine.hostname)
+    if include_host_details:
+        # with the interfaces and disks/block devices of the machine
+        host.status = machine.status.name
+        host.netboot = machine.netboot
+        host.architecture = machine.architecture
+        host.os = machine.osystem
+        host.distro_series = machine.distro_series
+        host.fqdn = machine.fqdn
+        host.cpus = machine.cpus
+        host.memory = machine.memory
+        host.interfaces = ifs
+        host.ip_addresses = machine.ip_addresses
+        host.system_id = machine.system_id
+        host.operating_system = ostype + "-" + oskernel
+        host.node_type = machine.node_type
+        host.pool = machine.pool.name
+        host.zone = machine.zone.name
+        host.block_devices = disks
+        host.tags = tags
+    return host
+
+
+def get_rack_controller_host(rack_controller, details: tuple, subnet_index: SubnetIndex, keys: tuple,
+                             current_user: str):
+    tags, ifs, _ = details
+    ostype = str(rack_controller.osystem)
+    oskernel = str(rack_controller.distro_series)
+
+    ansible_ip = get_ansible_host(rack_controller, subnet_index)
+
+    host = Host(keys, ansible_ip, current_user, rack_controller.hostname)
+    if include_host_details:
+        # with the interfaces of the rack controller
+        host.architecture = rack_controller.architecture
+        host.os = rack_controller.osystem
+        host.distro_series = rack_controller.distro_series
+        host.fqdn = rack_controller.fqdn
+        host.cpus = rack_controller.cpus
+        host.memory = rack_controller.memory
+        host.interfaces = ifs
+        host.ip_addresses = rack_controller.ip_addresses
+        host.system_id = rack_controller.system_id
+        host.operating_system = ostype + "-" + oskernel
+        host.node_type = rack_controller.node_type
+        host.zone = rack_controller.zone.name
+        host.tags = tags
+    return host
+
+
+# hostvars to output among all_keys, in their order
+def get_host_keys(all_keys: tuple, fields: set):
+    return tuple(key for key in all_keys if fields is None or key in fields)
+
+
+# Options the host dictionaries are built from, see Snapshot.built_hosts
+def get_host_options(fields: set):
+    return (include_host_details, tuple(sorted(fields)) if fields is not None else None,
+            ansible_management_space_name, none_user, ubuntu_user, centos8_user, centos7_user)
+
+
+# Pull the machines and rack controllers of the snapshot and reformat them to be more JSON and Ansible friendly
+# yields the Host record of each host as soon as it is built
+def iter_hosts(snapshot: Snapshot):
+    machines = get_inventory_machines(snapshot)
+    rack_controllers = get_inventory_rack_controllers(snapshot)
     current_user = None
     # get rack_controllers if we want to include them
     if include_rack_controllers:
-        rack_controllers = client.rack_controllers.list()
         # we use the current user for rack controllers as they are probably not deployed by maas
         current_user = getpass.getuser()
 
-    # get management network from specific space
-    space = client.spaces.get(ansible_management_space_name)
-    subnets = client.subnets.list()
-    management_network = None
-    for space_vlan in space.vlans:
-        for subnet in subnets:
-            if space_vlan.id == subnet.vlan.id:
-                management_network = ipaddress.ip_network(subnet.cidr)
-    maas_machines = {}
-    for machine in machines:
-        ostype = str(machine.osystem)
-        oskernel = str(machine.distro_series)
-        htags = list(machine.tags)
-        interfaces = list(machine.interfaces)
-        block_devices = list(machine.block_devices)
-        tags = [tag.name for tag in htags]
-
-        ansible_user = none_user
-        # Determine the ansible_user to assign by OS
-        if machine.osystem == "ubuntu":
-            ansible_user = ubuntu_user
-        if machine.osystem == "centos" and machine.distro_series == "8":
-            ansible_user = centos8_user
-        if machine.osystem == "centos" and machine.distro_series == "7":
-            ansible_user = centos7_user
-
-        ansible_ip = [ip for ip in machine.ip_addresses if ipaddress.ip_address(ip) in management_network][0]
-
-        if include_host_details:
-            this_os = ostype + "-" + oskernel
-            # Build a dictionary of network interfaces for each machine instance
-            ifs = [
-                {
-                    interface.name: {
-                        "type": interface.type.name,
-                        "enabled": interface.enabled,
-                        "id": interface.id,
-                        "mac_address": interface.mac_address,
-                        "params": interface.params,
-                        "mtu": interface.effective_mtu,
-                    }
-                }
-                for interface in interfaces
-            ]
-            # Build a dictionary of block devices (disks) for each machine instance
-            disks = [
-                {
-                    block_device.name: {
-                        "type": block_device.type.name,
-                        "model": block_device.model,
-                        "used_for": block_device.used_for,
-                        "size": block_device.size,
-                        "used": block_device.used_size,
-                        "block_size": block_device.block_size,
-                        "id": block_device.id,
-                        "id_path": block_device.id_path,
-                    }
-                }
-                for block_device in block_devices
-            ]
-            # Build the root dictionary for each machine instance
-            # with nested dictionaries for interfaces and disks/block devices
-            host = {
-                "ansible_host": ansible_ip,
-                "ansible_user": ansible_user,
-                "hostname": machine.hostname,
-                "status": machine.status.name,
-                "netboot": machine.netboot,
-                "architecture": machine.architecture,
-                "os": machine.osystem,
-                "distro_series": machine.distro_series,
-                "fqdn": machine.fqdn,
-                "cpus": machine.cpus,
-                "memory": machine.memory,
-                "interfaces": ifs,  # This is a dictionary
-                "ip_addresses": machine.ip_addresses,  # This is a list
-                "system_id": machine.system_id,
-                "operating_system": this_os,
-                "node_type": machine.node_type,
-                "pool": machine.pool.name,
-                "zone": machine.zone.name,
-                "block_devices": disks,  # This is a dictionary
-                "tags": tags
-            }
-        else:
-            host = {
-                "ansible_host": ansible_ip,
-                "ansible_user": ansible_user,
-                "hostname": machine.hostname
-            }
-        # Add each machine dictionary into a root dictionary as elements
+    # ansible_host is the IP in the management space
+    subnet_index = snapshot.subnet_index
+    # only the sub-resources of the requested hostvars are fetched
+    fields = get_host_fields()
+    sub_resources = get_sub_resources(fields)
+    host_options = get_host_options(fields)
+    machine_keys = get_host_keys(machine_host_keys, fields)
+    rack_controller_keys = get_host_keys(rack_controller_host_keys, fields)
+    built_hosts = snapshot.built_hosts
+    # a snapshot file has the details of every node in its payload, they are always built from it
+    use_payload = True if snapshot.offline else None
+    machines_details = get_hosts_details(machines, sub_resources, fetched=snapshot.fetched_details,
+                                         use_payload=use_payload)
+    for machine, details in zip(machines, machines_details):
+        key = (machine.system_id, host_options)
+        host = built_hosts.get(key)
+        if host is None:
+            host = built_hosts[key] = get_machine_host(machine, details, subnet_index, machine_keys)
         if not include_bare_metal:
             if machine.power_type == "virsh" or machine.power_type == "lxd":
-                meta.update({host["hostname"]: host})
-                maas_machines.update({host["hostname"]: host})
+                yield host
         else:
-            meta.update({host["hostname"]: host})
-            maas_machines.update({host["hostname"]: host})
+            yield host
 
     # do not need to test include_rack_controllers as rack_controllers list is empty
     # if include_rack_controllers=False
-    for rack_controller in rack_controllers:
-        ostype = str(rack_controller.osystem)
-        oskernel = str(rack_controller.distro_series)
-        htags = list(rack_controller.tags)
-        interfaces = list(rack_controller.interfaces)
-        tags = [tag.name for tag in htags]
-
-        ansible_ip = [ip for ip in rack_controller.ip_addresses if ipaddress.ip_address(ip) in management_network][0]
-
-        if include_host_details:
-            this_os = ostype + "-" + oskernel
-            # Build a dictionary of network interfaces for each rack_controller instance
-            ifs = [
-                {
-                    interface.name: {
-                        "type": interface.type.name,
-                        "enabled": interface.enabled,
-                        "id": interface.id,
-                        "mac_address": interface.mac_address,
-                        "params": interface.params,
-                        "mtu": interface.effective_mtu,
-                    }
-                }
-                for interface in interfaces
-            ]
-            # Build the root dictionary for each rack_controller instance
-            # with nested dictionaries for interfaces
-            host = {
-                "ansible_host": ansible_ip,
-                "ansible_user": current_user,
-                "hostname": rack_controller.hostname,
-                "architecture": rack_controller.architecture,
-                "os": rack_controller.osystem,
-                "distro_series": rack_controller.distro_series,
-                "fqdn": rack_controller.fqdn,
-                "cpus": rack_controller.cpus,
-                "memory": rack_controller.memory,
-                "interfaces": ifs,  # This is a dictionary
-                "ip_addresses": rack_controller.ip_addresses,  # This is a list
-                "system_id": rack_controller.system_id,
-                "operating_system": this_os,
-                "node_type": rack_controller.node_type,
-                "zone": rack_controller.zone.name,
-                "tags": tags
-            }
-        else:
-            host = {
-                "ansible_host": ansible_ip,
-                "ansible_user": current_user,
-                "hostname": rack_controller.hostname
-            }
-        meta.update({host["hostname"]: host})
-        maas_machines.update({host["hostname"]: host})
+    # rack_controllers have no block devices
+    rack_controllers_details = get_hosts_details(
+        rack_controllers,
+        tuple(sub_resource for sub_resource in sub_resources if sub_resource != "block_devices"),
+        fetched=snapshot.fetched_details,
+        use_payload=use_payload
+    )
+    for rack_controller, details in zip(rack_controllers, rack_controllers_details):
+        key = (rack_controller.system_id, host_options, current_user)
+        host = built_hosts.get(key)
+        if host is None:
+            host = built_hosts[key] = get_rack_controller_host(rack_controller, details, subnet_index,
+                                                               rack_controller_keys, current_user)
+        yield host
+
+
+@timed("hosts")
+def get_machines(meta: dict, snapshot: Snapshot = None):
+    if snapshot is None:
+        snapshot = get_snapshot()
+    maas_machines = {}
+    for host in iter_hosts(snapshot):
+        # Add each host record into a root dictionary as elements, the same record for both
+        meta.update({host.hostname: host})
+        maas_machines.update({host.hostname: host})
     maas_data = {"children": maas_machines}
     maas_inventory = {"maas": maas_data}
     return maas_inventory
 
 
-#
-def get_tags():
-    maas_tag_groups = {}
-    tags = client.tags.list()
-    maas_tags = [tag.name for tag in tags]
-    maas_machines = [
-        machine for machine in client.machines.list()
-        if not exclude_powered_off_machines or (machine.power_state == PowerState.ON and exclude_powered_off_machines)
-    ]
-    rack_controllers = []
-    if include_rack_controllers:
-        rack_controllers = client.rack_controllers.list()
-    for tag in maas_tags:
-        maas_tag_groups.update({tag: []})
-        for machine in maas_machines:
-            htag = repr(machine.tags)
-            status = htag.find(tag)
-            if status != -1:
-                if not include_bare_metal:
-                    if machine.power_type == "virsh" or machine.power_type == "lxd":
-                        maas_tag_groups[tag].append(machine.hostname)
-                else:
-                    maas_tag_groups[tag].append(machine.hostname)
-        # do not need to test include_rack_controllers as rack_controllers list is empty
-        # if include_rack_controllers=False
-        for rack_controller in rack_controllers:
-            htag = repr(rack_controller.tags)
-            status = htag.find(tag)
-            if status != -1:
-                maas_tag_groups[tag].append(rack_controller.hostname)
-    return maas_tag_groups
-
-
-def get_zones():
-    maas_zone_group = {}
-    zones = client.zones.list()
-    maas_zones = [zone.name for zone in zones]
-    maas_machines = [
-        machine for machine in client.machines.list()
-        if not exclude_powered_off_machines or (machine.power_state == PowerState.ON and exclude_powered_off_machines)
+# Tag names of a node, from the list payload or its tag objects
+def get_node_tag_names(node):
+    tag_names = node._data.get("tag_names")
+    if isinstance(tag_names, list):
+        return tag_names
+    return [tag.name for tag in node.tags]
+
+
+# Values of a node for a group key, which is a field of the machines list payload:
+# zone and pool give their name, list fields (tag_names, ip_addresses...) give each of their items
+def get_node_values(node, key: str):
+    if key == "tag_names":
+        return get_node_tag_names(node)
+    value = node._data.get(key)
+    if isinstance(value, dict):
+        value = value.get("name")
+    if value is None or value == "":
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+# Replace the characters Ansible does not accept in group names
+def to_safe_group_name(name: str):
+    return re.sub(r"[^A-Za-z0-9_]", "_", name)
+
+
+# A group definition is (key, function giving the group name of a value, names of the groups always created)
+def get_group_definition(key: str, prefix: str = None, separator: str = "_"):
+    if prefix is None:
+        prefix = key
+    return key, lambda value: to_safe_group_name(f"{prefix}{separator}{value}"), []
+
+
+# Group definitions enabled by the configuration
+# tags, zones and pools groups are named after them and created even when empty
+def get_group_definitions(snapshot: Snapshot):
+    group_definitions = []
+    if group_by_tags:
+        group_definitions.append(("tag_names", str, [tag.name for tag in snapshot.tags]))
+    if group_by_az:
+        group_definitions.append(("zone", str, [zone.name for zone in snapshot.zones]))
+    if group_by_pool:
+        group_definitions.append(("pool", str, [pool.name for pool in snapshot.pools]))
+    for keyed_group in keyed_groups:
+        group_definitions.append(
+            get_group_definition(keyed_group["key"], keyed_group.get("prefix"), keyed_group.get("separator", "_"))
+        )
+    return group_definitions
+
+
+# Build the host groups of every definition in a single pass over the hosts,
+# each host is added to the groups of its own values, so membership is an exact match
+@timed("groups")
+def get_groups(snapshot: Snapshot, group_definitions: list):
+    groups_by_definition = [
+        {group_name(name): [] for name in names} for _, group_name, names in group_definitions
     ]
-    rack_controllers = []
-    if include_rack_controllers:
-        rack_controllers = client.rack_controllers.list()
-    for zone in maas_zones:
-        maas_zone_group.update({zone: []})
-        for machine in maas_machines:
-            if machine.zone.name == zone:
-                if not include_bare_metal:
-                    if machine.power_type == "virsh" or machine.power_type == "lxd":
-                        maas_zone_group[zone].append(machine.hostname)
-                else:
-                    maas_zone_group[zone].append(machine.hostname)
-        # do not need to test include_rack_controllers as rack_controllers list is empty
-        # if include_rack_controllers=False
-        for rack_controller in rack_controllers:
-            if rack_controller.zone.name == zone:
-                maas_zone_group[zone].append(rack_controller.hostname)
-    return maas_zone_group
-
-
-def get_pools():
-    maas_pool_group = {}
-    pools = client.resource_pools.list()
-    maas_pools = [pool.name for pool in pools]
-    maas_machines = [
-        machine for machine in client.machines.list()
-        if not exclude_powered_off_machines or (machine.power_state == PowerState.ON and exclude_powered_off_machines)
+    nodes = [
+        machine for machine in get_inventory_machines(snapshot)
+        if include_bare_metal or machine.power_type == "virsh" or machine.power_type == "lxd"
     ]
-    rack_controllers = []
-    if include_rack_controllers:
-        rack_controllers = client.rack_controllers.list()
-    for pool in maas_pools:
-        maas_pool_group.update({pool: []})
-        for machine in maas_machines:
-            if machine.pool.name == pool:
-                if not include_bare_metal:
-                    if machine.power_type == "virsh" or machine.power_type == "lxd":
-                        maas_pool_group[pool].append(machine.hostname)
-                else:
-                    maas_pool_group[pool].append(machine.hostname)
-        # do not need to test include_rack_controllers as rack_controllers list is empty
-        for rack_controller in rack_controllers:
-            if rack_controller.pool.name == pool:
-                maas_pool_group[pool].append(rack_controller.hostname)
-    return maas_pool_group
-
-
-def get_inventory():
+    # do not need to test include_rack_controllers as rack_controllers list is empty
+    # if include_rack_controllers=False
+    nodes += get_inventory_rack_controllers(snapshot)
+    for node in nodes:
+        for (key, group_name, _), groups in zip(group_definitions, groups_by_definition):
+            for value in dict.fromkeys(get_node_values(node, key)):
+                groups.setdefault(group_name(value), []).append(node.hostname)
+    maas_groups = {}
+    for groups in groups_by_definition:
+        maas_groups.update(groups)
+    return maas_groups
+
+
+def get_tags(snapshot: Snapshot = None):
+    if snapshot is None:
+        snapshot = get_snapshot()
+    return get_groups(snapshot, [("tag_names", str, [tag.name for tag in snapshot.tags])])
+
+
+def get_zones(snapshot: Snapshot = None):
+    if snapshot is None:
+        snapshot = get_snapshot()
+    return get_groups(snapshot, [("zone", str, [zone.name for zone in snapshot.zones])])
+
+
+def get_pools(snapshot: Snapshot = None):
+    if snapshot is None:
+        snapshot = get_snapshot()
+    return get_groups(snapshot, [("pool", str, [pool.name for pool in snapshot.pools])])
+
+
+def get_inventory(snapshot: Snapshot = None):
+    if snapshot is None:
+        snapshot = get_snapshot()
     meta = {
         "_meta": {
             "hostvars": {}
         }
     }
-    machines = get_machines(meta)
-    if group_by_tags:
-        tags = get_tags()
-        machines.update(tags)
-    if group_by_az:
-        zones = get_zones()
-        machines.update(zones)
-    if group_by_pool:
-        pools = get_pools()
-        machines.update(pools)
+    machines = get_machines(meta, snapshot)
+    groups = get_groups(snapshot, get_group_definitions(snapshot))
+    set_count("hosts", len(machines["maas"]["children"]))
+    set_count("groups", len(groups))
+    machines.update(groups)
     machines.update(meta)
     return machines
 
 
-def main():
-    inventory = get_inventory()
-    print(json.dumps(inventory, indent=4))
+# Hosts and groups of a region, the groups are only built for the whole region (hostnames=None)
+def get_region_hosts_and_groups(region: str, hostnames: list = None):
+    snapshot = get_snapshot(hostnames=hostnames, region=region)
+    hosts = get_machines({}, snapshot)["maas"]["children"]
+    if hostnames is not None:
+        return hosts, {}
+    return hosts, get_groups(snapshot, get_group_definitions(snapshot))
+
+
+# values of region_hostname_collision
+region_hostname_collisions = ("first", "rename")
+
+
+# Fetch every region of maas_regions in parallel, the results are in the order of maas_regions
+# the options are checked before, not after fetching every region
+def get_regions_hosts_and_groups(hostnames: list = None):
+    if region_hostname_collision not in region_hostname_collisions:
+        raise ValueError(f"invalid region_hostname_collision: {region_hostname_collision!r}")
+    executor = get_executor("regions", len(maas_regions))
+    return list(executor.map(partial(get_region_hosts_and_groups, hostnames=hostnames), maas_regions))
+
+
+# Merge the hosts and groups of the regions in the order of maas_regions,
+# a hostname already taken by a previous region is handled according to region_hostname_collision
+# a renamed host keeps its MaaS hostname in its "hostname" hostvar, as its fqdn and the other hostvars of MaaS
+# groups of the same name are merged, a region_<name> group is added for each region
+def merge_regions(regions_hosts_and_groups: list):
+    hosts = {}
+    groups = {}
+    region_groups = {}
+    for region, (region_hosts, groups_of_region) in zip(maas_regions, regions_hosts_and_groups):
+        # name in the merged inventory of the hosts of the region that are kept
+        names = {}
+        collisions = []
+        for hostname, host in region_hosts.items():
+            name = hostname
+            if name in hosts:
+                collisions.append(hostname)
+                if region_hostname_collision == "rename":
+                    name = f"{hostname}_{to_safe_group_name(region)}"
+                if name in hosts:
+                    continue
+            names[hostname] = name
+            hosts[name] = host
+        if collisions:
+            action = "left out"
+            if region_hostname_collision == "rename":
+                action = "renamed to <hostname>_" + to_safe_group_name(region)
+            print(f"WARNING: {len(collisions)} hosts of region {region} are already in the inventory and are {action}:"
+                  f" {', '.join(collisions)}", file=sys.stderr)
+        for group, hostnames in groups_of_region.items():
+            groups.setdefault(group, []).extend(names[hostname] for hostname in hostnames if hostname in names)
+        region_groups[to_safe_group_name(f"region_{region}")] = list(names.values())
+    groups.update(region_groups)
+    return hosts, groups
+
+
+# Same layout as get_inventory, with the hosts and groups of every region of maas_regions
+def get_regions_inventory():
+    hosts, groups = merge_regions(get_regions_hosts_and_groups())
+    set_count("hosts", len(hosts))
+    set_count("groups", len(groups))
+    inventory = {"maas": {"children": hosts}}
+    inventory.update(groups)
+    inventory["_meta"] = {"hostvars": {}}
+    inventory.update(hosts)
+    return inventory
+
+
+# Variables of a single host of the merged inventory, only the hosts of the same name are requested
+# with region_hostname_collision="rename", <hostname>_<region> is also looked up as <hostname>
+def get_regions_host(hostname: str):
+    hostnames = [hostname]
+    if region_hostname_collision == "rename":
+        for region in maas_regions:
+            suffix = "_" + to_safe_group_name(region)
+            if hostname.endswith(suffix):
+                hostnames.append(hostname[:-len(suffix)])
+    hosts, _ = merge_regions(get_regions_hosts_and_groups(hostnames))
+    return hosts.get(hostname, {})
+
+
+# Hosts by hostname and groups by name of MAAS_URL, or of maas_regions when it is set
+def get_hosts_and_groups():
+    if maas_regions:
+        return merge_regions(get_regions_hosts_and_groups())
+    snapshot = get_snapshot()
+    hosts = get_machines({}, snapshot)["maas"]["children"]
+    groups = get_groups(snapshot, get_group_definitions(snapshot))
+    set_count("hosts", len(hosts))
+    set_count("groups", len(groups))
+    return hosts, groups
+
+
+# Inventory of MAAS_URL, or of maas_regions when it is set
+def build_inventory():
+    if maas_regions:
+        return get_regions_inventory()
+    return get_inventory()
+
+
+# JSON encoder returning compact bytes, orjson is used when it is installed
+def get_json_encoder():
+    try:
+        import orjson
+    except ImportError:
+        encoder = json.JSONEncoder(separators=(",", ":"), default=to_plain_data)
+        return lambda data: encoder.encode(data).encode()
+    return partial(orjson.dumps, default=to_plain_data)
+
+
+# Write the same inventory as get_inventory as compact JSON, each host is written as soon as it is built
+# instead of building the whole inventory first, a host is encoded once for both places it appears in
+@timed("output")
+def stream_inventory(stream, snapshot: Snapshot = None):
+    if snapshot is None:
+        snapshot = get_snapshot()
+    encode = get_json_encoder()
+    encoded_hosts = {}
+    separator = b""
+    stream.write(b'{"maas":{"children":{')
+    for host in iter_hosts(snapshot):
+        encoded_host = encode(host)
+        encoded_hosts[host.hostname] = encoded_host
+        stream.write(separator + encode(host.hostname) + b":" + encoded_host)
+        separator = b","
+    stream.write(b"}}")
+    groups = get_groups(snapshot, get_group_definitions(snapshot))
+    set_count("hosts", len(encoded_hosts))
+    set_count("groups", len(groups))
+    for name, hostnames in groups.items():
+        stream.write(b"," + encode(name) + b":" + encode(hostnames))
+    stream.write(b',"_meta":' + encode({"hostvars": {}}))
+    for hostname, encoded_host in encoded_hosts.items():
+        stream.write(b"," + encode(hostname) + b":" + encoded_host)
+    stream.write(b"}\n")
+
+
+@timed("output")
+def print_json(data):
+    if compact_output:
+        sys.stdout.buffer.write(get_json_encoder()(data) + b"\n")
+    else:
+        print(json.dumps(data, indent=4, default=to_plain_data))
+
+
+# Same bytes as print_json
+def encode_json(data, compact: bool):
+    if compact:
+        return get_json_encoder()(data) + b"\n"
+    return (json.dumps(data, indent=4, default=to_plain_data) + "\n").encode()
+
+
+# Path and modification time of snapshot_file, so that a new snapshot is not answered from the cache of the previous one
+def get_snapshot_file_key():
+    if not snapshot_file:
+        return None
+    return [os.path.abspath(snapshot_file), os.stat(snapshot_file).st_mtime_ns]
+
+
+# Options changing the generated inventory, the cache is keyed on them
+def get_cache_key():
+    options = {
+        "maas_url": maas_url,
+        "snapshot_file": get_snapshot_file_key(),
+        "maas_regions": [[region, get_region_url(region)] for region in maas_regions],
+        "region_hostname_collision": region_hostname_collision,
+        "group_by_tags": group_by_tags,
+        "group_by_az": group_by_az,
+        "group_by_pool": group_by_pool,
+        "include_bare_metal": include_bare_metal,
+        "include_host_details": include_host_details,
+        "host_fields": host_fields,
+        "include_rack_controllers": include_rack_controllers,
+        "exclude_powered_off_machines": exclude_powered_off_machines,
+        "keyed_groups": keyed_groups,
+        "ansible_management_space_name": ansible_management_space_name,
+    }
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+# Returns the cached inventory and its age in seconds, or (None, None) if there is none
+def read_cache(path: str):
+    try:
+        with open(path) as cache_file:
+            age = time.time() - os.fstat(cache_file.fileno()).st_mtime
+            return json.load(cache_file), age
+    except (OSError, ValueError):
+        return None, None
+
+
+# Write to a temporary file then rename it, so readers never see a partial inventory
+def write_cache(path: str, inventory: dict):
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump(inventory, tmp_file, default=to_plain_data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# Remove expired inventories and the oldest ones above cache_max_entries
+# the lock of an entry is only removed when nobody holds it, the other files of
+# cache_dir (MaaS versions) are not inventories and are kept
+def evict_cache():
+    entries = []
+    for name in os.listdir(cache_dir):
+        if re.fullmatch(r"[0-9a-f]{64}\.json", name):
+            path = os.path.join(cache_dir, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                continue
+    entries.sort(reverse=True)
+    expired = time.time() - cache_ttl - cache_stale_ttl
+    for index, (mtime, path) in enumerate(entries):
+        if index < cache_max_entries and mtime >= expired:
+            continue
+        lock_path = path[:-len(".json")] + ".lock"
+        try:
+            with open(lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.unlink(path)
+                os.unlink(lock_path)
+        except OSError:
+            continue
+
+
+# Rebuild the inventory and store it
+def refresh_cache(path: str):
+    inventory = build_inventory()
+    write_cache(path, inventory)
+    evict_cache()
+    return inventory
+
+
+# Store an inventory built by another script from the same options, see OpenstackAnsible.py --inventory
+def store_cached_inventory(inventory: dict):
+    os.makedirs(cache_dir, exist_ok=True)
+    write_cache(os.path.join(cache_dir, get_cache_key() + ".json"), inventory)
+    evict_cache()
+
+
+# Refresh the cache in a detached child process, which keeps the lock until it is done
+# the parent can return the stale inventory right away
+def refresh_cache_in_background(path: str):
+    if not hasattr(os, "fork"):
+        refresh_cache(path)
+        return
+    if os.fork() != 0:
+        return
+    # child: detach from Ansible, which waits for stdout to be closed
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    init_worker_event_loop()
+    try:
+        refresh_cache(path)
+    finally:
+        os._exit(0)
+
+
+# Return the cached inventory if it is fresh, otherwise rebuild it
+# concurrent runs wait for the one holding the lock instead of all querying MaaS
+def get_cached_inventory():
+    os.makedirs(cache_dir, exist_ok=True)
+    key = get_cache_key()
+    path = os.path.join(cache_dir, key + ".json")
+    inventory, age = read_cache(path)
+    if inventory is not None and age <= cache_ttl:
+        return inventory
+    with open(os.path.join(cache_dir, key + ".lock"), "a") as lock_file:
+        if inventory is not None and age <= cache_ttl + cache_stale_ttl:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another run is already refreshing it
+                return inventory
+            refresh_cache_in_background(path)
+            return inventory
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # the run holding the lock before us may have just refreshed it
+        inventory, age = read_cache(path)
+        if inventory is not None and age <= cache_ttl:
+            return inventory
+        return refresh_cache(path)
+
+
+# Variables of a single host, only this host is requested from MaaS
+# returns an empty dictionary when the host is not in the inventory
+def get_host(hostname: str):
+    if maas_regions:
+        return get_regions_host(hostname)
+    snapshot = get_snapshot(hostnames=[hostname])
+    meta = {}
+    get_machines(meta, snapshot)
+    return meta.get(hostname, {})
+
+
+# Variables of a single host from a fresh cached inventory, None if there is none
+def get_cached_host(hostname: str):
+    inventory, age = read_cache(os.path.join(cache_dir, get_cache_key() + ".json"))
+    if inventory is None or age > cache_ttl:
+        return None
+    return inventory["maas"]["children"].get(hostname, {})
+
+
+# Inventory kept in memory by the daemon, with the responses already encoded
+# it only answers runs whose options give the same cache key, the others build their own inventory
+class InventoryDaemon:
+    def __init__(self):
+        self.key = get_cache_key()
+        self.inventory = None
+        self.responses = {}
+        # unknown hosts share the same empty response, caching each of them would grow without limit
+        self.empty_responses = {compact: encode_json({}, compact) for compact in (False, True)}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        inventory = build_inventory()
+        with self.lock:
+            self.inventory = inventory
+            self.responses = {}
+
+    # the previous inventory is served while it is rebuilt, or if rebuilding it fails
+    def refresh_forever(self, stop: threading.Event):
+        init_worker_event_loop()
+        while not stop.wait(daemon_refresh_interval):
+            try:
+                self.refresh()
+            except Exception as error:
+                print(f"WARNING: could not refresh the inventory, serving the previous one: {error!r}",
+                      file=sys.stderr)
+
+    # /list or /host/<hostname>, None for any other path
+    def get_response(self, path: str, compact: bool):
+        with self.lock:
+            inventory, responses = self.inventory, self.responses
+        response = responses.get((path, compact))
+        if response is not None:
+            return response
+        if path == "/list":
+            data = inventory
+        elif path.startswith("/host/"):
+            data = inventory["maas"]["children"].get(unquote(path[len("/host/"):]))
+            if data is None:
+                return self.empty_responses[compact]
+        else:
+            return None
+        response = encode_json(data, compact)
+        with self.lock:
+            responses[(path, compact)] = response
+        return response
+
+
+def get_daemon_handler(daemon: InventoryDaemon):
+    class DaemonRequestHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            response = None
+            if query.get("key") == [daemon.key]:
+                response = daemon.get_response(url.path, query.get("compact") == ["1"])
+            if response is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+    return DaemonRequestHandler
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def get_daemon_connection():
+    if daemon_socket.startswith("http://"):
+        url = urlsplit(daemon_socket)
+        return http.client.HTTPConnection(url.hostname, url.port, timeout=daemon_timeout)
+    return UnixHTTPConnection(daemon_socket, daemon_timeout)
+
+
+# Listen on daemon_socket, a Unix socket is only accessible to the user running the daemon
+# and is replaced if it was left behind by a daemon that is not running anymore
+def get_daemon_server(handler):
+    if daemon_socket.startswith("http://"):
+        url = urlsplit(daemon_socket)
+        server = ThreadingHTTPServer((url.hostname, url.port), handler)
+        server.daemon_threads = True
+        return server
+    if os.path.exists(daemon_socket):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as test_socket:
+                test_socket.connect(daemon_socket)
+        except ConnectionRefusedError:
+            os.unlink(daemon_socket)
+        else:
+            raise OSError(f"a daemon is already listening on {daemon_socket}")
+    umask = os.umask(0o177)
+    try:
+        return UnixHTTPServer(daemon_socket, handler)
+    finally:
+        os.umask(umask)
+
+
+# Build the inventory, then serve it until interrupted or terminated
+def serve():
+    daemon = InventoryDaemon()
+    daemon.refresh()
+    server = get_daemon_server(get_daemon_handler(daemon))
+    stop = threading.Event()
+    threading.Thread(target=daemon.refresh_forever, args=(stop,), daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        if not daemon_socket.startswith("http://"):
+            os.unlink(daemon_socket)
+
+
+# Output of --list, or of --host when hostname is given, from the daemon
+# None when it is not running, does not answer in time or was started with other options
+def query_daemon(hostname: str = None):
+    path = "/list" if hostname is None else "/host/" + quote(hostname, safe="")
+    query = urlencode({"key": get_cache_key(), "compact": int(compact_output)})
+    connection = get_daemon_connection()
+    try:
+        connection.request("GET", f"{path}?{query}")
+        response = connection.getresponse()
+        body = response.read()
+    except (OSError, http.client.HTTPException):
+        return None
+    finally:
+        connection.close()
+    if response.status != 200:
+        return None
+    return body
+
+
+# Options that can be set from the command line or from MAAS_<OPTION> environment variables,
+# they default to the values set in CONFIGURATION
+cli_options = {
+    "group_by_tags": bool,
+    "group_by_az": bool,
+    "group_by_pool": bool,
+    "include_bare_metal": bool,
+    "include_host_details": bool,
+    "host_fields": list,
+    "include_rack_controllers": bool,
+    "exclude_powered_off_machines": bool,
+    "ansible_management_space_name": str,
+    "maas_regions": list,
+    "region_hostname_collision": str,
+    "snapshot_file": str,
+    "use_bulk_payload": bool,
+    "use_cache": bool,
+    "cache_dir": str,
+    "cache_ttl": int,
+    "cache_stale_ttl": int,
+    "compact_output": bool,
+    "metrics_output": str,
+    "request_timeout": float,
+    "request_retries": int,
+    "request_retry_backoff": float,
+    "use_daemon": bool,
+    "daemon_socket": str,
+    "daemon_refresh_interval": int,
+    "daemon_timeout": float,
+}
+# values accepted by the options that only take some
+cli_choices = {
+    "region_hostname_collision": region_hostname_collisions,
+}
+
+
+def parse_bool(value: str):
+    if value.lower() in ("1", "true", "yes", "on"):
+        return True
+    if value.lower() in ("0", "false", "no", "off", ""):
+        return False
+    raise ValueError(f"invalid boolean value: {value!r}")
+
+
+# comma separated values
+def parse_list(value: str):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser(description="Ansible dynamic inventory for Canonical MaaS")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--list", action="store_true", help="print the whole inventory (default)")
+    action.add_argument("--host", metavar="HOSTNAME", help="print the variables of a single host")
+    action.add_argument("--serve", action="store_true",
+                        help="keep the inventory in memory and answer the runs using the daemon, see daemon_socket")
+    action.add_argument("--export-snapshot", metavar="FILE",
+                        help="write the MaaS state to FILE, to build the inventory from it later, see snapshot_file")
+    for name, option_type in cli_options.items():
+        flag = "--" + name.replace("_", "-")
+        help_text = f"defaults to $MAAS_{name.upper()} or {globals()[name]!r}"
+        if option_type is bool:
+            parser.add_argument(flag, action=argparse.BooleanOptionalAction, default=None, help=help_text)
+        elif option_type is list:
+            parser.add_argument(flag, type=parse_list, default=None, help=help_text + ", comma separated")
+        else:
+            parser.add_argument(flag, type=option_type, choices=cli_choices.get(name), default=None, help=help_text)
+    return parser.parse_args(argv)
+
+
+# Set the options given on the command line, or else in the environment
+def apply_options(args: argparse.Namespace):
+    for name, option_type in cli_options.items():
+        value = getattr(args, name)
+        if value is None:
+            env_value = os.getenv(f"MAAS_{name.upper()}")
+            if env_value is None:
+                continue
+            if option_type is bool:
+                value = parse_bool(env_value)
+            elif option_type is list:
+                value = parse_list(env_value)
+            else:
+                value = option_type(env_value)
+        globals()[name] = value
+
+
+# Set module options for the duration of the block, for scripts building several outputs from one run
+@contextmanager
+def options(**values):
+    previous = {name: globals()[name] for name in values}
+    globals().update(values)
+    try:
+        yield
+    finally:
+        globals().update(previous)
+
+
+def main(argv: list = None):
+    args = parse_args(argv)
+    apply_options(args)
+    start_metrics("AnsibleMaaS")
+    try:
+        with phase("total"):
+            run(args)
+    except RuntimeError as error:
+        # message on stderr and a non-zero exit status, the output is not an inventory
+        sys.exit(f"ERROR: {error}")
+    finally:
+        write_metrics()
+
+
+def run(args: argparse.Namespace):
+    if args.serve:
+        serve()
+        return
+    if args.export_snapshot is not None:
+        export_snapshot(args.export_snapshot)
+        return
+    if use_daemon:
+        with phase("daemon"):
+            response = query_daemon(args.host)
+        if response is not None:
+            sys.stdout.buffer.write(response)
+            return
+    if args.host is not None:
+        host = get_cached_host(args.host) if use_cache else None
+        if host is None:
+            host = get_host(args.host)
+        print_json(host)
+        return
+    if use_cache:
+        with phase("cache"):
+            inventory = get_cached_inventory()
+    elif compact_output and not maas_regions:
+        stream_inventory(sys.stdout.buffer)
+        return
+    else:
+        inventory = build_inventory()
+    print_json(inventory)
 
 
 if __name__ == '__main__':
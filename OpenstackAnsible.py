@@ -2,22 +2,45 @@
 # Script to generate a config for openstack-ansible from MaaS inventory
 # Import modules needed for this to work
 # If this errors use "pip" to install the needed modules (in requirements.txt)
+import argparse
 import datetime
+import hashlib
 import ipaddress
-
-import yaml
+import json
+import os
+import stat
+import sys
+import tempfile
 
 import AnsibleMaaS
-from AnsibleMaaS import client, get_tags, get_machines
+from AnsibleMaaS import Snapshot, SubnetIndex, get_snapshot, get_tags, get_machines, phase, set_count
 
+# AnsibleMaaS.py defaults of the options overridden below, used for the inventory written with --inventory
+inventory_options = {
+    'include_rack_controllers': AnsibleMaaS.include_rack_controllers,
+    'exclude_powered_off_machines': AnsibleMaaS.exclude_powered_off_machines,
+}
 # include rack_controllers as hosts, used as True to deploy openstack-ansible also on these hosts
 AnsibleMaaS.include_rack_controllers = True
 # not excluding powered off hosts as this script only generates an
 # openstack_user_config.yml file which can be used later
 AnsibleMaaS.exclude_powered_off_machines = False
+# "stderr" or the path of a Prometheus textfile to output the timings of the run, see AnsibleMaaS.py
+AnsibleMaaS.metrics_output = os.getenv('MAAS_METRICS_OUTPUT', AnsibleMaaS.metrics_output)
+# path of a file written by AnsibleMaaS.py --export-snapshot to generate the config from, see AnsibleMaaS.py
+AnsibleMaaS.snapshot_file = os.getenv('MAAS_SNAPSHOT_FILE', AnsibleMaaS.snapshot_file)
 
 # filename to use for generated config
 user_config_filename = 'openstack_user_config.yml.generated'
+# directory to write each host group to its own <group>.yml file, as in the conf.d directory of openstack-ansible,
+# None keeps the groups in user_config_filename
+conf_d_dirname = None
+# print on stderr what changed in the config since the previous run: the hosts added, removed or changed in each
+# group and the other sections changed, from the hashes kept in .<user_config_filename>.hashes.json
+print_diff_summary = True
+
+# sections of the config which are not host groups
+config_sections = ('cidr_networks', 'global_overrides', 'used_ips')
 
 # the management network is used for connecting through SSH to hosts and for connecting to deployed containers
 management_network_name = 'management'
@@ -28,26 +51,62 @@ storage_network_name = 'storage'
 
 # the number of days to be taken into account for discoveries
 nb_days_discoveries = 7
+# True will also add to used_ips the reserved ranges (dynamic, reserved, gateway...) MaaS reports
+# for the subnets of the cidr_networks
+include_reserved_ip_ranges = False
 
 
-def get_cidr_networks_config(cidr_networks, subnets):
+def get_cidr_networks_config(cidr_networks, subnet_index: SubnetIndex):
     for name, cidr in cidr_networks.items():
-        space = client.spaces.get(name)
-        for space_vlan in space.vlans:
-            for subnet in subnets:
-                if space_vlan.id == subnet.vlan.id:
-                    cidr_networks[name] = ipaddress.ip_network(subnet.cidr)
+        networks = subnet_index.get_space_networks(name)
+        # openstack-ansible takes one cidr per network, use the last subnet of the space
+        if networks:
+            cidr_networks[name] = networks[-1]
     cidr_networks_config = [{name: str(cidr) if cidr else None} for name, cidr in cidr_networks.items()]
     return cidr_networks_config
 
 
-def get_used_ips_config(discoveries):
+# IPs of the discoveries seen during the nb_days_discoveries days before now, a timestamp
+# MaaS cannot filter discoveries on last_seen, they are filtered one by one from the payload
+def iter_discovered_ips(discoveries: list, now: float):
     days = datetime.timedelta(days=nb_days_discoveries)
-    now = datetime.datetime.now()
-    last_seen_max = (now - days).date()
-    used_ips_config = list(
-        set([discovery.ip for discovery in discoveries if discovery.last_seen.date() > last_seen_max])
-    )
+    last_seen_max = (datetime.datetime.fromtimestamp(now) - days).date()
+    for discovery in discoveries:
+        if discovery['ip'] and datetime.datetime.fromisoformat(discovery['last_seen']).date() > last_seen_max:
+            yield discovery['ip']
+
+
+# (start, end) of the ranges MaaS reserves in the subnets of the cidr_networks
+def iter_reserved_ip_ranges(snapshot: Snapshot, cidr_networks):
+    for cidr in cidr_networks.values():
+        indexed_subnet = snapshot.subnet_index.get(cidr.network_address) if cidr else None
+        if indexed_subnet is None:
+            continue
+        for reserved_range in snapshot.get_reserved_ip_ranges(indexed_subnet.subnet.id):
+            yield reserved_range['start'], reserved_range['end']
+
+
+# Sorted used_ips, each run of contiguous addresses is given as the "start,end" range openstack-ansible accepts
+# ip_ranges are (start, end) couples, a single IP is given as (ip, ip)
+def get_used_ips_config(ip_ranges):
+    ranges = []
+    for start, end in ip_ranges:
+        start, end = ipaddress.ip_address(start), ipaddress.ip_address(end)
+        ranges.append((start.version, int(start), int(end)))
+    ranges.sort()
+    collapsed = []
+    for version, start, end in ranges:
+        if collapsed and collapsed[-1][0] == version and start <= collapsed[-1][2] + 1:
+            collapsed[-1][2] = max(collapsed[-1][2], end)
+        else:
+            collapsed.append([version, start, end])
+    used_ips_config = []
+    for version, start, end in collapsed:
+        address = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+        if start == end:
+            used_ips_config.append(str(address(start)))
+        else:
+            used_ips_config.append(f'{address(start)},{address(end)}')
     return used_ips_config
 
 
@@ -134,53 +193,253 @@ def get_global_overrides_config():
     return global_overrides_config
 
 
-def get_groups_config(cidr_networks, machines, tags):
+def get_groups_config(subnet_index: SubnetIndex, machines, tags):
     groups = {}
     for tag in tags:
         group_name = f"{tag}_hosts"
         groups[group_name] = {}
         for hostname in machines[tag]:
+            # host record of AnsibleMaaS.py
             machine = machines['maas']['children'][hostname]
-            management_ip = None
-            if len(machine['ip_addresses']) > 0:
-                for ip_address in machine['ip_addresses']:
-                    ip_address_obj = ipaddress.ip_address(ip_address)
-                    management_network = cidr_networks[management_network_name]
-                    if management_network is not None and ip_address_obj in management_network:
-                        management_ip = ip_address
+            # None when the host has no IP in any subnet of the management space
+            management_ip = subnet_index.get_space_ip(machine.ip_addresses, management_network_name)
             groups[group_name][hostname] = {
                 'ip': management_ip,
                 'host_vars': {
-                    'ansible_user': machine['ansible_user'],
+                    'ansible_user': machine.ansible_user,
                 },
             }
     return groups
 
 
-def main():
-    machines = get_machines({})
-    tags = get_tags()
+# Options of the inventory written with --inventory, the same as AnsibleMaaS.py --list would use:
+# its defaults overridden by the MAAS_* environment variables
+def get_inventory_options():
+    current = {name: getattr(AnsibleMaaS, name) for name in AnsibleMaaS.cli_options}
+    with AnsibleMaaS.options(**current), AnsibleMaaS.options(**inventory_options):
+        AnsibleMaaS.apply_options(AnsibleMaaS.parse_args([]))
+        return {name: getattr(AnsibleMaaS, name) for name in AnsibleMaaS.cli_options}
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser(description="Generate an openstack-ansible config from the MaaS inventory")
+    parser.add_argument("--inventory", metavar="FILE",
+                        help="also write to FILE the inventory of AnsibleMaaS.py --list, from the same MaaS requests")
+    parser.add_argument("--snapshot-file", metavar="FILE",
+                        help="read the MaaS state from FILE written by AnsibleMaaS.py --export-snapshot"
+                             " instead of requesting MaaS, defaults to $MAAS_SNAPSHOT_FILE")
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None):
+    args = parse_args(argv)
+    AnsibleMaaS.start_metrics("OpenstackAnsible")
+    try:
+        with phase("total"):
+            run(args)
+    except RuntimeError as error:
+        sys.exit(f"ERROR: {error}")
+    finally:
+        AnsibleMaaS.write_metrics()
+
+
+# PyYAML dumper, the one of libyaml when PyYAML was built with it
+def get_yaml_dumper():
+    import yaml
+    return getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+# Same text as yaml.safe_dump
+def render_yaml(data):
+    import yaml
+    return yaml.dump(data, Dumper=get_yaml_dumper()).encode()
+
+
+# Mode of the file at path, or of a new file
+def get_file_mode(path: str):
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+# Write content to path unless the file already has it, so its mtime only changes with its content
+# and the openstack-ansible steps watching it are not triggered again, returns True if the file was written
+# the content is written to a temporary file renamed over path, readers never see a partial file
+def write_if_changed(path: str, content: bytes):
+    try:
+        with open(path, 'rb') as current_file:
+            if os.fstat(current_file.fileno()).st_size == len(content) and current_file.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(content)
+        os.chmod(tmp_path, get_file_mode(path))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+def get_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+# Hashes of the sections and of each host of each group of the config, compared with the ones of the previous run
+# for the diff summary, instead of parsing the previous config
+def get_user_config_hashes(user_config: dict):
+    hashes = {'sections': {}, 'groups': {}}
+    for name, value in user_config.items():
+        if name in config_sections:
+            hashes['sections'][name] = get_hash(value)
+        else:
+            hashes['groups'][name] = {hostname: get_hash(host) for hostname, host in value.items()}
+    return hashes
+
+
+def get_hashes_path():
+    directory, filename = os.path.split(user_config_filename)
+    return os.path.join(directory, f'.{filename}.hashes.json')
+
+
+def load_previous_hashes():
+    try:
+        with open(get_hashes_path()) as hashes_file:
+            return json.load(hashes_file)
+    except (OSError, ValueError):
+        return None
+
+
+def format_hostnames(hostnames: list, limit: int = 10):
+    if len(hostnames) > limit:
+        return ', '.join(hostnames[:limit]) + f'... ({len(hostnames) - limit} more)'
+    return ', '.join(hostnames)
+
+
+# Lines describing what changed between the previous hashes and the current ones
+def get_diff_summary(previous: dict, current: dict):
+    lines = []
+    for name, digest in current['sections'].items():
+        if previous['sections'].get(name) != digest:
+            lines.append(f'{name}: changed')
+    for group in sorted(previous['groups'].keys() - current['groups'].keys()):
+        lines.append(f'{group}: removed')
+    for group, hosts in current['groups'].items():
+        previous_hosts = previous['groups'].get(group)
+        if previous_hosts is None:
+            lines.append(f'{group}: added with {len(hosts)} hosts')
+            continue
+        changes = []
+        added = [hostname for hostname in hosts if hostname not in previous_hosts]
+        removed = [hostname for hostname in previous_hosts if hostname not in hosts]
+        changed = [hostname for hostname, digest in hosts.items() if previous_hosts.get(hostname, digest) != digest]
+        for action, hostnames in (('added', added), ('removed', removed), ('changed', changed)):
+            if hostnames:
+                changes.append(f'{len(hostnames)} {action} ({format_hostnames(hostnames)})')
+        if changes:
+            lines.append(f'{group}: ' + ', '.join(changes))
+    return lines
+
+
+# Write user_config_filename, and the groups to conf_d_dirname when it is set, only the files whose content
+# changed are written, the conf.d files of groups which are gone are removed
+# returns the number of files written or removed
+def write_user_config(user_config: dict):
+    files = {}
+    if conf_d_dirname is None:
+        files[user_config_filename] = user_config
+    else:
+        files[user_config_filename] = {name: value for name, value in user_config.items() if name in config_sections}
+        for name, value in user_config.items():
+            if name not in config_sections:
+                files[os.path.join(conf_d_dirname, f'{name}.yml')] = {name: value}
+        os.makedirs(conf_d_dirname, exist_ok=True)
+    written = 0
+    for path, data in files.items():
+        written += write_if_changed(path, render_yaml(data))
+
+    previous = load_previous_hashes()
+    hashes = get_user_config_hashes(user_config)
+    hashes['conf_d_files'] = sorted(path for path in files if path != user_config_filename)
+    if previous is not None:
+        for path in previous.get('conf_d_files', []):
+            if path not in files and os.path.exists(path):
+                os.unlink(path)
+                written += 1
+        if print_diff_summary:
+            for line in get_diff_summary(previous, hashes) or [f'{user_config_filename}: unchanged']:
+                print(line, file=sys.stderr)
+    write_if_changed(get_hashes_path(), json.dumps(hashes, sort_keys=True).encode())
+    return written
+
+
+def run(args: argparse.Namespace):
+    if args.snapshot_file is not None:
+        AnsibleMaaS.snapshot_file = args.snapshot_file
+    # share one snapshot so machines, tags, spaces and subnets are listed only once,
+    # for both the config and the inventory
+    snapshot = get_snapshot()
+    user_config = get_user_config(snapshot)
+    inventory_json = None
+    if args.inventory is not None:
+        inventory_json = get_inventory_json(snapshot)
+    with phase("output"):
+        written = write_user_config(user_config)
+        if inventory_json is not None:
+            written += write_if_changed(args.inventory, inventory_json)
+    set_count("files_written", written)
+
+
+# Same output as AnsibleMaaS.py --list with its own options, the hosts details already fetched for the config
+# are reused, the inventory is also stored in the AnsibleMaaS.py cache when use_cache is set
+def get_inventory_json(snapshot: Snapshot):
+    with AnsibleMaaS.options(**get_inventory_options()):
+        if AnsibleMaaS.maas_regions:
+            # the config only uses MAAS_URL, the regions are fetched on their own
+            inventory = AnsibleMaaS.build_inventory()
+        else:
+            inventory = AnsibleMaaS.get_inventory(snapshot)
+        if AnsibleMaaS.use_cache:
+            AnsibleMaaS.store_cached_inventory(inventory)
+        return AnsibleMaaS.encode_json(inventory, AnsibleMaaS.compact_output)
+
+
+def get_user_config(snapshot: Snapshot):
+    machines = get_machines({}, snapshot)
+    tags = get_tags(snapshot)
+    set_count("hosts", len(machines["maas"]["children"]))
+    set_count("groups", len(tags))
     machines.update(tags)
-    subnets = client.subnets.list()
-    discoveries = client.discoveries.list()
+    discoveries = snapshot.discoveries
     cidr_networks = {
         management_network_name: None,
         tunnel_network_name: None,
         storage_network_name: None,
     }
 
-    cidr_networks_config = get_cidr_networks_config(cidr_networks=cidr_networks, subnets=subnets)
-    used_ips_config = get_used_ips_config(discoveries=discoveries)
-    global_overrides_config = get_global_overrides_config()
-    groups = get_groups_config(cidr_networks=cidr_networks, machines=machines, tags=tags)
-    user_config: dict = {
-        'cidr_networks': cidr_networks_config,
-        'global_overrides': global_overrides_config,
-        'used_ips': used_ips_config,
-        **groups
-    }
-    with open(user_config_filename, 'w') as user_config_file:
-        yaml.safe_dump(user_config, user_config_file)
+    with phase("config"):
+        cidr_networks_config = get_cidr_networks_config(cidr_networks=cidr_networks, subnet_index=snapshot.subnet_index)
+        used_ip_ranges = [(ip, ip) for ip in iter_discovered_ips(discoveries, snapshot.taken_at)]
+        if include_reserved_ip_ranges:
+            used_ip_ranges += iter_reserved_ip_ranges(snapshot, cidr_networks)
+        used_ips_config = get_used_ips_config(used_ip_ranges)
+        global_overrides_config = get_global_overrides_config()
+        groups = get_groups_config(subnet_index=snapshot.subnet_index, machines=machines, tags=tags)
+        user_config: dict = {
+            'cidr_networks': cidr_networks_config,
+            'global_overrides': global_overrides_config,
+            'used_ips': used_ips_config,
+            **groups
+        }
+    set_count("discoveries", len(discoveries))
+    set_count("used_ips", len(used_ips_config))
+    return user_config
 
 
 if __name__ == '__main__':
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# Measure AnsibleMaaS.py and OpenstackAnsible.py against fake_maas.py for a range of fleet sizes.
+# Every mode runs in a fresh interpreter with an empty cache directory, so module state, the cached
+# version check and the inventory cache of a previous run never leak into the next one.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from fake_maas import FakeMaaS, Fleet
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name: (script, arguments, number of unmeasured runs before the measured one)
+modes = {
+    'default': ('AnsibleMaaS', ['--list'], 0),
+    'all-groups': ('AnsibleMaaS', ['--list', '--group-by-az', '--group-by-pool', '--include-rack-controllers'], 0),
+    'no-details': ('AnsibleMaaS', ['--list', '--no-include-host-details'], 0),
+    'objects': ('AnsibleMaaS', ['--list', '--no-use-bulk-payload'], 0),
+    'compact': ('AnsibleMaaS', ['--list', '--compact-output'], 0),
+    'cache-hit': ('AnsibleMaaS', ['--list', '--use-cache'], 1),
+    'host': ('AnsibleMaaS', ['--host', 'host00000'], 0),
+    'openstack': ('OpenstackAnsible', [], 0),
+    'openstack-inventory': ('OpenstackAnsible', ['--inventory', 'inventory.json'], 0),
+}
+
+# Runs inside the child interpreter, the script output goes to /dev/null and the measures to stdout
+child_code = '''
+import json, os, resource, sys, time, tracemalloc
+script, argv, trace = json.loads(sys.argv[1])
+sys.path.insert(0, os.environ["BENCHMARK_REPO_DIR"])
+result = sys.stdout
+sys.stdout = open(os.devnull, "w")
+if trace:
+    tracemalloc.start()
+start = time.perf_counter()
+module = __import__(script)
+module.main(argv)
+sys.stdout.flush()
+measures = {
+    "wall": time.perf_counter() - start,
+    "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+}
+if trace:
+    measures["traced_peak"] = tracemalloc.get_traced_memory()[1]
+json.dump(measures, result)
+'''
+
+
+def parse_int_list(value: str):
+    return [int(item) for item in value.split(",") if item]
+
+
+def parse_args(argv: list = None):
+    parser = argparse.ArgumentParser(description="Benchmark the inventory scripts against a fake MaaS API")
+    parser.add_argument("--machines", type=parse_int_list, default=[10, 100, 1000],
+                        help="fleet sizes, comma separated (default 10,100,1000)")
+    parser.add_argument("--modes", type=lambda value: value.split(","), default=list(modes),
+                        help="comma separated, any of " + ", ".join(modes))
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every API request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="ratio of API requests failing with a 503")
+    parser.add_argument("--rack-controllers", type=int, default=1)
+    parser.add_argument("--tags", type=int, default=5)
+    parser.add_argument("--zones", type=int, default=2)
+    parser.add_argument("--pools", type=int, default=2)
+    parser.add_argument("--interfaces", type=int, default=2, help="per node")
+    parser.add_argument("--disks", type=int, default=2, help="per machine")
+    parser.add_argument("--subnets", type=int, default=1, help="per space")
+    parser.add_argument("--discoveries", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=1, help="measured runs per mode, the fastest one is kept")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also report the peak of Python allocations (slows the runs down)")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    args = parser.parse_args(argv)
+    unknown = [mode for mode in args.modes if mode not in modes]
+    if unknown:
+        parser.error("unknown modes: " + ", ".join(unknown))
+    return args
+
+
+def run_once(server: FakeMaaS, mode: str, trace: bool, work_dir: str):
+    script, argv, _ = modes[mode]
+    env = dict(os.environ)
+    env.update({
+        "MAAS_URL": server.url,
+        "MAAS_API_KEY": "fake:fake:fake",
+        "XDG_CACHE_HOME": os.path.join(work_dir, "cache"),
+        "BENCHMARK_REPO_DIR": repo_dir,
+    })
+    process = subprocess.run(
+        [sys.executable, "-c", child_code, json.dumps([script, argv, trace])],
+        cwd=work_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    if process.returncode:
+        error = process.stderr.decode().strip().splitlines() or [f"exit status {process.returncode}"]
+        raise RuntimeError(error[-1])
+    return json.loads(process.stdout)
+
+
+def run_mode(server: FakeMaaS, mode: str, repeat: int, trace: bool):
+    best = None
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(prefix="maas-benchmark-") as work_dir:
+            for _ in range(modes[mode][2]):
+                run_once(server, mode, trace, work_dir)
+            server.reset_counts()
+            measures = run_once(server, mode, trace, work_dir)
+            measures["requests"] = dict(sorted(server.counts.items()))
+        if best is None or measures["wall"] < best["wall"]:
+            best = measures
+    return best
+
+
+def format_bytes(size: int):
+    return f"{size / 1024 / 1024:.1f}M"
+
+
+def print_result(machines: int, mode: str, measures: dict):
+    requests = measures["requests"]
+    endpoints = " ".join(f"{name}={count}" for name, count in requests.items())
+    memory = format_bytes(measures["max_rss"])
+    if "traced_peak" in measures:
+        memory += f" (heap {format_bytes(measures['traced_peak'])})"
+    print(f"{machines:>7} {mode:<20} {measures['wall']:>9.3f}s {sum(requests.values()):>8} {memory:>20}  {endpoints}",
+          flush=True)
+
+
+def main(argv: list = None):
+    args = parse_args(argv)
+    results = []
+    print(f"{'nodes':>7} {'mode':<20} {'wall':>10} {'requests':>8} {'peak memory':>20}  requests per endpoint")
+    for machines in args.machines:
+        fleet = Fleet(machines=machines, rack_controllers=args.rack_controllers, tags=args.tags, zones=args.zones,
+                      pools=args.pools, interfaces=args.interfaces, disks=args.disks,
+                      subnets_per_space=args.subnets, discoveries=args.discoveries)
+        with FakeMaaS(fleet, latency=args.latency, error_rate=args.error_rate) as server:
+            for mode in args.modes:
+                try:
+                    measures = run_mode(server, mode, args.repeat, args.tracemalloc)
+                except RuntimeError as error:
+                    print(f"{machines:>7} {mode:<20} failed: {error}", flush=True)
+                    results.append({"machines": machines, "mode": mode, "latency": args.latency,
+                                    "error": str(error)})
+                    continue
+                print_result(machines, mode, measures)
+                results.append({"machines": machines, "mode": mode, "latency": args.latency, **measures})
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
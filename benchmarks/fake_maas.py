@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# Local stand-in for the MaaS region API, good enough for python-libmaas to connect to
+# and for AnsibleMaaS.py / OpenstackAnsible.py to build a full inventory against.
+# It serves a synthetic fleet generated from a few counts and records every request.
+# Used by benchmark.py, can also be run on its own to point the scripts at it by hand.
+import collections
+import datetime
+import ipaddress
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+API_PATH = '/MAAS/api/2.0/'
+
+# handler name, path below API_PATH, uri params, extra (non restful) read ops
+HANDLERS = [
+    ('VersionHandler', 'version/', [], []),
+    ('MachinesHandler', 'machines/', [], []),
+    ('MachineHandler', 'machines/{system_id}/', ['system_id'], []),
+    ('RackControllersHandler', 'rackcontrollers/', [], []),
+    ('TagsHandler', 'tags/', [], []),
+    ('ZonesHandler', 'zones/', [], []),
+    ('ResourcePoolsHandler', 'resourcepools/', [], []),
+    ('SpacesHandler', 'spaces/', [], []),
+    ('SpaceHandler', 'spaces/{id}/', ['id'], []),
+    ('SubnetsHandler', 'subnets/', [], []),
+    ('SubnetHandler', 'subnets/{id}/', ['id'], ['reserved_ip_ranges']),
+    ('IPRangesHandler', 'ipranges/', [], []),
+    ('DiscoveriesHandler', 'discovery/', [], []),
+    ('EventsHandler', 'events/', [], ['query']),
+]
+
+NODE_STATUS_DEPLOYED = 6
+NODE_TYPE_MACHINE = 0
+NODE_TYPE_RACK_CONTROLLER = 2
+
+
+def _vlan(vlan_id, space_name):
+    return {
+        'id': vlan_id,
+        'vid': vlan_id,
+        'fabric_id': 0,
+        'fabric': 'fabric-0',
+        'name': f'vlan-{vlan_id}',
+        'mtu': 1500,
+        'space': space_name,
+        'dhcp_on': False,
+        'external_dhcp': None,
+        'primary_rack': None,
+        'secondary_rack': None,
+        'relay_vlan': None,
+    }
+
+
+class Fleet:
+    # Deterministic synthetic MaaS state. Every machine gets one address in each space
+    # so the management/tunnel/storage lookups of both scripts have something to find.
+    def __init__(self, machines=10, rack_controllers=1, tags=5, zones=2, pools=2, interfaces=2, disks=2,
+                 spaces=('management', 'tunnel', 'storage'), subnets_per_space=1, discoveries=100,
+                 powered_off_ratio=0.1, seed=0):
+        rnd = random.Random(seed)
+        self.tags = [{'name': f'tag{i}', 'comment': '', 'definition': '', 'kernel_opts': ''} for i in range(tags)]
+        self.zones = [{'id': i + 1, 'name': f'zone{i}', 'description': ''} for i in range(zones)]
+        self.pools = [{'id': i, 'name': f'pool{i}', 'description': ''} for i in range(pools)]
+        self.spaces = []
+        self.subnets = []
+        self.space_networks = {}
+        vlan_id = 5000
+        subnet_id = 1
+        for space_id, space_name in enumerate(spaces):
+            vlans = []
+            self.space_networks[space_name] = []
+            for index in range(subnets_per_space):
+                vlan_id += 1
+                vlan = _vlan(vlan_id, space_name)
+                vlans.append(vlan)
+                network = ipaddress.ip_network(f'10.{space_id * 16 + index}.0.0/16')
+                self.space_networks[space_name].append(network)
+                self.subnets.append({
+                    'id': subnet_id,
+                    'name': str(network),
+                    'cidr': str(network),
+                    'vlan': vlan,
+                    'space': space_name,
+                    'gateway_ip': str(network[1]),
+                    'dns_servers': [],
+                    'managed': True,
+                    'active_discovery': True,
+                    'allow_proxy': True,
+                    'rdns_mode': 2,
+                })
+                subnet_id += 1
+            self.spaces.append({'id': space_id, 'name': space_name, 'vlans': vlans,
+                                'subnets': [s for s in self.subnets if s['space'] == space_name]})
+        self.ipranges = [
+            {'id': i + 1, 'type': 'reserved', 'start_ip': str(subnet_net[10]), 'end_ip': str(subnet_net[20]),
+             'comment': '', 'subnet': subnet}
+            for i, (subnet, subnet_net) in enumerate(
+                (s, ipaddress.ip_network(s['cidr'])) for s in self.subnets
+            )
+        ]
+        self.machines = [self._node(i, rnd, NODE_TYPE_MACHINE, interfaces, disks, powered_off_ratio)
+                         for i in range(machines)]
+        self.rack_controllers = [self._node(machines + i, rnd, NODE_TYPE_RACK_CONTROLLER, interfaces, disks, 0)
+                                 for i in range(rack_controllers)]
+        now = datetime.datetime.now()
+        first_network = self.space_networks[spaces[0]][0]
+        self.discoveries = [
+            {
+                'discovery_id': f'd{i}',
+                'ip': str(first_network[1000 + rnd.randrange(max(discoveries, 1) * 2)]),
+                'mac_address': '02:00:00:%02x:%02x:%02x' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                'last_seen': (now - datetime.timedelta(hours=rnd.randrange(24 * 14))).isoformat(),
+                'hostname': None,
+                'fabric_name': 'fabric-0',
+                'vid': 0,
+            }
+            for i in range(discoveries)
+        ]
+
+    def _node(self, index, rnd, node_type, interfaces, disks, powered_off_ratio):
+        system_id = f'n{index:05d}'
+        hostname = f'host{index:05d}'
+        ips = []
+        for space_name, networks in self.space_networks.items():
+            network = networks[index % len(networks)]
+            ips.append(str(network[index + 2]))
+        interface_set = [
+            {
+                'id': index * 100 + i,
+                'system_id': system_id,
+                'name': f'eth{i}',
+                'type': 'physical' if i else 'bridge',
+                'enabled': True,
+                'mac_address': '52:54:%02x:%02x:%02x:%02x' % (index >> 16 & 255, index >> 8 & 255, index & 255, i),
+                'effective_mtu': 1500,
+                'params': {'bridge_stp': False} if i == 0 else '',
+                'tags': [],
+                'vlan': None,
+                'links': [],
+                'parents': [],
+                'children': [],
+                'discovered': [],
+            }
+            for i in range(interfaces)
+        ]
+        blockdevice_set = [
+            {
+                'id': index * 100 + i,
+                'system_id': system_id,
+                'name': f'sd{chr(97 + i)}',
+                'type': 'physical',
+                'model': 'QEMU HARDDISK',
+                'serial': f'disk{index}-{i}',
+                'id_path': f'/dev/disk/by-id/{system_id}-{i}',
+                'size': 10000007168,
+                'block_size': 512,
+                'used_size': 9996075008,
+                'available_size': 3932160,
+                'used_for': 'GPT partitioned with 2 partitions',
+                'uuid': None,
+                'tags': [],
+                'partition_table_type': 'GPT',
+                'partitions': [],
+                'filesystem': None,
+            }
+            for i in range(disks)
+        ]
+        zone = self.zones[index % len(self.zones)] if self.zones else {'id': 1, 'name': 'default', 'description': ''}
+        pool = self.pools[index % len(self.pools)] if self.pools else {'id': 0, 'name': 'default', 'description': ''}
+        tag_names = [tag['name'] for tag in self.tags if rnd.random() < 0.3]
+        node = {
+            'system_id': system_id,
+            'hostname': hostname,
+            'fqdn': f'{hostname}.maas',
+            'domain': {'id': 0, 'name': 'maas'},
+            'node_type': node_type,
+            'architecture': 'amd64/generic',
+            'osystem': 'ubuntu',
+            'distro_series': 'jammy',
+            'cpu_count': 4,
+            'memory': 8192,
+            'ip_addresses': ips,
+            'interface_set': interface_set,
+            'blockdevice_set': blockdevice_set,
+            'tag_names': tag_names,
+            'zone': zone,
+            'pool': pool,
+            'power_state': 'off' if rnd.random() < powered_off_ratio else 'on',
+            'power_type': 'virsh' if index % 2 else 'ipmi',
+            'owner': None,
+            'status': NODE_STATUS_DEPLOYED,
+            'status_name': 'Deployed',
+            'netboot': False,
+        }
+        if node_type == NODE_TYPE_RACK_CONTROLLER:
+            del node['blockdevice_set'], node['netboot'], node['status'], node['status_name']
+        return node
+
+
+class FakeMaaS:
+    # Serves `fleet` on 127.0.0.1. `latency` (seconds) is added to every API request,
+    # `error_rate` of them (except describe) fail with a 503 like an overloaded region.
+    def __init__(self, fleet, latency=0.0, version='3.4.0', error_rate=0.0, seed=0):
+        self.fleet = fleet
+        self.latency = latency
+        self.version = version
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self.counts = collections.Counter()
+        # encoded responses by request path, see reset()
+        self._bodies = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}/MAAS/'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts.clear()
+
+    # forget the encoded responses after changing the fleet
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+            self._bodies.clear()
+
+    def describe(self):
+        base = self.url + 'api/2.0/'
+        resources = []
+        for name, path, params, ops in HANDLERS:
+            actions = [{'name': 'read', 'method': 'GET', 'op': None, 'restful': True, 'doc': ''}]
+            actions += [{'name': op, 'method': 'GET', 'op': op, 'restful': False, 'doc': ''} for op in ops]
+            handler = {
+                'name': name,
+                'doc': '',
+                'params': params,
+                'actions': actions,
+                'uri': base + path,
+                'path': API_PATH + path,
+            }
+            resources.append({'name': name, 'anon': None, 'auth': handler})
+        return {'doc': 'MAAS API', 'hash': 'fake', 'handlers': [], 'resources': resources}
+
+    def _route(self, path, query):
+        fleet = self.fleet
+        parts = path[len(API_PATH):].strip('/').split('/')
+        endpoint = parts[0]
+        if endpoint == 'describe':
+            return endpoint, self.describe()
+        if endpoint == 'version':
+            return endpoint, {'version': self.version, 'subversion': 'fake', 'capabilities': []}
+        if endpoint == 'machines':
+            if len(parts) > 1:
+                return 'machine', next((m for m in fleet.machines if m['system_id'] == parts[1]), None)
+            hostnames = set(query.get('hostname', []))
+            if hostnames:
+                return endpoint, [m for m in fleet.machines if m['hostname'] in hostnames]
+            return endpoint, fleet.machines
+        if endpoint == 'rackcontrollers':
+            return endpoint, fleet.rack_controllers
+        if endpoint == 'tags':
+            return endpoint, fleet.tags
+        if endpoint == 'zones':
+            return endpoint, fleet.zones
+        if endpoint == 'resourcepools':
+            return endpoint, fleet.pools
+        if endpoint == 'spaces':
+            if len(parts) > 1:
+                key = parts[1]
+                return 'space', next((s for s in fleet.spaces if str(s['id']) == key or s['name'] == key), None)
+            return endpoint, fleet.spaces
+        if endpoint == 'subnets':
+            if len(parts) > 1:
+                subnet = next((s for s in fleet.subnets if str(s['id']) == parts[1]), None)
+                if query.get('op') == ['reserved_ip_ranges'] and subnet is not None:
+                    return 'subnet_reserved_ip_ranges', [
+                        {'start': r['start_ip'], 'end': r['end_ip'], 'num_addresses': 11, 'purpose': ['reserved']}
+                        for r in fleet.ipranges if r['subnet']['id'] == subnet['id']
+                    ]
+                return 'subnet', subnet
+            return endpoint, fleet.subnets
+        if endpoint == 'ipranges':
+            return endpoint, fleet.ipranges
+        if endpoint == 'discovery':
+            return endpoint, fleet.discoveries
+        if endpoint == 'events':
+            return endpoint, {'count': 0, 'events': [], 'next_uri': '', 'prev_uri': ''}
+        return endpoint, None
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # send headers and body at once, not in two segments delayed by Nagle on kept-alive connections
+            disable_nagle_algorithm = True
+            wbufsize = -1
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                with fake._lock:
+                    cached = fake._bodies.get(self.path)
+                if cached is None:
+                    endpoint, payload = None, None
+                    if url.path.startswith(API_PATH):
+                        endpoint, payload = fake._route(url.path, parse_qs(url.query))
+                    if payload is None:
+                        cached = endpoint, 404, json.dumps({'error': 'not found'}).encode()
+                    else:
+                        cached = endpoint, 200, json.dumps(payload).encode()
+                    with fake._lock:
+                        fake._bodies[self.path] = cached
+                endpoint, status, body = cached
+                with fake._lock:
+                    fake.counts[endpoint] += 1
+                    if fake.error_rate and endpoint != 'describe' and fake._random.random() < fake.error_rate:
+                        fake.counts['errors'] += 1
+                        status, body = 503, b'{"error": "service unavailable"}'
+                if fake.latency and endpoint != 'describe':
+                    time.sleep(fake.latency)
+                self._send(status, body)
+
+            def _send(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve a synthetic MaaS fleet on localhost')
+    parser.add_argument('--machines', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    with FakeMaaS(Fleet(machines=args.machines), latency=args.latency, error_rate=args.error_rate) as server:
+        print(f'MAAS_URL={server.url}')
+        print('MAAS_API_KEY=fake:fake:fake')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass